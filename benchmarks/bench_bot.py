@@ -0,0 +1,192 @@
+"""End-to-end throughput benchmark. Drives the Bot against the local mock server for synthetic accounts of different
+sizes and reports village-cycles/sec, requests and CPU per village-cycle, and peak memory.
+
+All sleeps (between villages, after requests, in the rate limiter) run on a virtual clock, so only the time spent
+working and waiting on the network is measured.
+
+Run it from the project root with: python -m benchmarks.bench_bot --villages 1 10 100 1000
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from unittest import mock
+
+import requests
+
+from benchmarks import mock_server
+from src.bot import Bot
+from src.core import events
+from src.core.config import Config
+from src.core.file_manager import FileManager, write_behind
+from src.core.time_utils import TimeUtils
+
+PROJECT_ROOT = FileManager.get_root_path()
+
+
+class VirtualClock:
+    """Clock of which time.time and time.monotonic run at real speed, but sleeping skips ahead instead of waiting. The
+    offset is a shared value, so the mock server process runs on the same clock."""
+
+    def __init__(self, offset):
+        self.real_time = time.time
+        self.real_monotonic = time.monotonic
+        self.offset = offset
+        self.slept = 0.0
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.real_time() + self.offset.value
+
+    def monotonic(self):
+        return self.real_monotonic() + self.offset.value
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.offset.value += max(0, seconds)
+            self.slept += max(0, seconds)
+
+    @contextmanager
+    def patch(self):
+        """Route all time and sleep calls of the bot through this clock."""
+        with mock.patch("time.time", self.time), mock.patch("time.monotonic", self.monotonic), \
+                mock.patch("time.sleep", self.sleep), mock.patch.object(TimeUtils, "sleep", staticmethod(self.sleep)):
+            yield self
+
+
+class BenchConfig(Config):
+    """Config that starts from the example config and points the bot at the mock server."""
+
+    def __init__(self, base_url, workers, transport="requests", json_first=True):
+        config = FileManager.load_yaml_file(self.config_file_example)
+        config["bot"]["auto_manage_new_villages"] = True
+        config["bot"]["workers"] = workers
+        config["web"].update({
+            "server": "mock",
+            "domain": "localhost",
+            "base_url": base_url,
+            "transport": transport,
+            "json_first": json_first,
+            "user-agent": "TribalWarsBot benchmark",
+        })
+        config["villages"] = []
+        super().__init__(config)
+
+
+def create_workspace():
+    """Create a project root with the strategies and a session cookie, so the benchmark never touches real data."""
+    workspace = tempfile.mkdtemp(prefix="twb-bench-")
+    shutil.copytree(os.path.join(PROJECT_ROOT, "strategy"), os.path.join(workspace, "strategy"))
+    os.makedirs(os.path.join(workspace, "data"))
+    with open(os.path.join(workspace, "data", "cookies.json"), "w") as file:
+        json.dump(json.dumps({"sid": "benchmark"}), file)
+    return workspace
+
+
+def start_server(villages, page_size, clock_offset):
+    """Start the mock server in its own process so its CPU time is not counted. Returns the process and url."""
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    process = context.Process(target=mock_server.serve, args=(villages, page_size, 0, ready, clock_offset),
+                              daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{ready.get(timeout=30)}"
+
+
+def run_cycle(bot, workers):
+    if workers > 1:
+        bot.run_villages_concurrently(workers)
+    else:
+        bot.run_villages()
+    bot.flush_store()
+
+
+def benchmark(villages, cycles, workers, page_size, transport, json_first=True):
+    """Benchmark one account size and return the measured numbers."""
+    clock = VirtualClock(multiprocessing.get_context("spawn").Value("d", 0.0, lock=False))
+    process, base_url = start_server(villages, page_size, clock.offset)
+    workspace = create_workspace()
+    config = BenchConfig(base_url, workers, transport, json_first)
+
+    def server_stats():
+        return requests.get(f"{base_url}/__stats").json()
+
+    try:
+        with clock.patch(), mock.patch.object(FileManager, "get_root_path", staticmethod(lambda: workspace)):
+            events.subscribers.clear()
+            events.queued_deliveries.clear()
+            bot = Bot(config)
+            bot.villages = bot.get_villages()
+
+            stats_before = server_stats()
+            wall_time = 0.0
+            cpu_time = 0.0
+            for _ in range(cycles):
+                wall_start, cpu_start = time.perf_counter(), time.process_time()
+                run_cycle(bot, workers)
+                wall_time += time.perf_counter() - wall_start
+                cpu_time += time.process_time() - cpu_start
+            stats_after = server_stats()
+
+            # Measure memory in a separate cycle, tracing allocations slows everything down
+            tracemalloc.start()
+            run_cycle(bot, workers)
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            bot.web.close()
+            if bot.store is not None:
+                bot.store.close()
+            # Write the config to the workspace while it is still the root
+            write_behind.flush()
+    finally:
+        process.terminate()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    village_cycles = villages * cycles
+    return {
+        "villages": villages,
+        "village_cycles_per_sec": village_cycles / wall_time,
+        "requests_per_village_cycle": (stats_after["requests"] - stats_before["requests"]) / village_cycles,
+        "kb_per_village_cycle": (stats_after["bytes"] - stats_before["bytes"]) / village_cycles / 1024,
+        "cpu_ms_per_village_cycle": cpu_time / village_cycles * 1000,
+        "peak_memory_mb": peak_memory / 1024 / 1024,
+        "virtual_sleep_sec": clock.slept,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot against a local mock server")
+    parser.add_argument("--villages", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--transport", default="requests", choices=["requests", "async"])
+    parser.add_argument("--html", action="store_true", help="fetch screens as full pages instead of json first")
+    parser.add_argument("--page-size", type=int, default=150000, help="bytes of filler added to every page")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    results = [benchmark(villages, args.cycles, args.workers, args.page_size, args.transport, not args.html)
+               for villages in args.villages]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'villages':>8} {'cycles/s':>10} {'req/cycle':>10} {'KB/cycle':>10} {'CPU ms/cycle':>13} {'peak MB':>9}")
+    for result in results:
+        print(f"{result['villages']:>8} {result['village_cycles_per_sec']:>10.1f} "
+              f"{result['requests_per_village_cycle']:>10.2f} {result['kb_per_village_cycle']:>10.1f} "
+              f"{result['cpu_ms_per_village_cycle']:>13.2f} {result['peak_memory_mb']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
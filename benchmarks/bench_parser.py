@@ -0,0 +1,290 @@
+"""Parser benchmark over a corpus of stored game pages. For every page it checks that every PageParser method and
+WebWrapper.update_after_request give the expected output, and measures their time and the memory they allocate per
+call. Every call gets a fresh response, so nothing is memoized between calls.
+
+The corpus is in benchmarks/corpus: gzipped pages, pages.json with the file and url of every page and expected.json.gz
+with the expected outputs. Run it from the project root with: python -m benchmarks.bench_parser
+
+All pages of the corpus are synthetic: the mock server generates them and the outputs were recorded from the parser
+itself. The check is a regression check, a change to the parser that changes its output on these pages shows up as
+mismatches. It can't tell whether the parser still understands the layout of the real game. To cover that, gzip a page
+that was saved from the game into the corpus, add it to pages.json with its url and run with --update to record its
+outputs. Check the recorded outputs by hand (with zcat), they are what the next runs are checked against. --generate
+rebuilds the synthetic pages from the mock server.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+from benchmarks import mock_server
+from src.core.page_parser import PageParser
+from src.core.web_wrapper import WebWrapper
+from src.model.village import VillageData
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "corpus")
+INDEX_FILE = os.path.join(CORPUS_PATH, "pages.json")
+EXPECTED_FILE = os.path.join(CORPUS_PATH, "expected.json.gz")
+BASE_URL = "https://nl95.tribalwars.nl"
+# Time of the synthetic world, so generating the corpus again gives the same pages
+WORLD_TIME = 1700000000
+
+# PageParser methods of which the output isn't checked, parse returns the parsed page itself
+unchecked = {"parse"}
+
+
+def parser_methods():
+    """Get the names of all PageParser methods."""
+    return [name for name, value in vars(PageParser).items() if isinstance(value, staticmethod)]
+
+
+def update_after_request(response):
+    """Run WebWrapper.update_after_request on a web wrapper without a session, and get what it updated."""
+    web = object.__new__(WebWrapper)
+    web.base_headers = {}
+    web.lock = threading.Lock()
+    web.update_after_request(response)
+    return {"csrf_token": web.base_headers.get("X-CSRF-Token"), "referer": web.base_headers.get("Referer"),
+            "last_h": web.last_h}
+
+
+def get_targets():
+    """Get the functions to check and measure by name. Every function takes a response."""
+    targets = {name: getattr(PageParser, name) for name in parser_methods()}
+    targets["WebWrapper.update_after_request"] = update_after_request
+    return targets
+
+
+def normalize(name, value):
+    """Turn an output into plain json, the way it is stored in expected.json.gz."""
+    if name == "get_villages_from_overview":
+        # The order of the villages is not defined
+        value = sorted(value)
+
+    def encode(value):
+        if isinstance(value, VillageData):
+            return value.to_json()
+        raise TypeError(f"Can't store {type(value).__name__}")
+
+    return json.loads(json.dumps(value, default=encode))
+
+
+def load_corpus():
+    with open(INDEX_FILE) as file:
+        index = json.load(file)
+    expected = {}
+    if os.path.exists(EXPECTED_FILE):
+        with gzip.open(EXPECTED_FILE, "rt", encoding="utf-8") as file:
+            expected = json.load(file)
+
+    pages = {}
+    for name, entry in index.items():
+        with gzip.open(os.path.join(CORPUS_PATH, entry["file"]), "rt", encoding="utf-8") as file:
+            pages[name] = {**entry, "text": file.read(), "expected": expected.get(name, {})}
+    return pages
+
+
+def save_gzip(path, text):
+    # mtime=0 keeps the file the same when the text is the same
+    with open(path, "wb") as file:
+        file.write(gzip.compress(text.encode("utf-8"), mtime=0))
+
+
+def save_corpus(pages):
+    """Save the pages, the index with their files and urls and the expected outputs."""
+    os.makedirs(CORPUS_PATH, exist_ok=True)
+    for page in pages.values():
+        save_gzip(os.path.join(CORPUS_PATH, page["file"]), page["text"])
+
+    with open(INDEX_FILE, "w") as file:
+        json.dump({name: {"file": page["file"], "url": page["url"]} for name, page in pages.items()}, file, indent=2,
+                  sort_keys=True)
+        file.write("\n")
+    save_gzip(EXPECTED_FILE, json.dumps({name: page["expected"] for name, page in pages.items()}, indent=2,
+                                        sort_keys=True))
+
+
+def get_response(page):
+    """Get a new response for the page, like the ones of the transports."""
+    return SimpleNamespace(text=page["text"], url=page["url"])
+
+
+def generate_corpus():
+    """Build the synthetic pages from the mock server: small and large accounts, empty and full build queues and
+    pages with and without the finish early button, both as full pages and as json."""
+    small = mock_server.MockWorld(5, seed=1)
+    large = mock_server.MockWorld(1000, seed=2)
+    for world in (small, large):
+        world.now = lambda: WORLD_TIME
+        for village in world.villages.values():
+            village.last_tick = WORLD_TIME
+
+    def add_orders(village, count):
+        village.resources = [1e9, 1e9, 1e9]
+        for building in ("main", "wood", "stone", "iron", "farm")[:count]:
+            village.order(building, WORLD_TIME)
+        village.resources = [4000.0, 3000.0, 2000.0]
+
+    empty, queued, full = small.villages[1], small.villages[2], small.villages[3]
+    add_orders(queued, 2)
+    add_orders(full, 5)
+
+    def screen(world, village, name, content, partial=False, **params):
+        query = "".join(f"&{key}={value}" for key, value in params.items())
+        body, game_data, scripts = content if isinstance(content, tuple) else (content, None, "")
+        content_type, text = world.screen(village, body, game_data, scripts, partial)
+        url = f"{BASE_URL}/game.php?village={village.id}&screen={name}{query}" + ("&_partial" if partial else "")
+        return {"url": url, "text": text}
+
+    def main_without_finish_early(village):
+        return small.main(village, finish_early_button=False)
+
+    def action(world, village, name, **form):
+        village.resources = [1e5, 1e5, 1e5]
+        url = f"{BASE_URL}/game.php?village={village.id}&ajaxaction={name}&type=main&screen=main"
+        _, _, text = world.handle("POST", urlparse(url), form)
+        return {"url": url, "text": text}
+
+    pages = {
+        "main_empty_queue": screen(small, empty, "main", small.main(empty)),
+        "main_queue_finish_early": screen(small, queued, "main", small.main(queued)),
+        "main_queue_no_finish_early": screen(small, queued, "main", main_without_finish_early(queued)),
+        "main_full_queue": screen(small, full, "main", small.main(full)),
+        "main_full_queue_json": screen(small, full, "main", small.main(full), partial=True),
+        "main_empty_queue_json": screen(small, empty, "main", small.main(empty), partial=True),
+        "overview_village": screen(small, empty, "overview_village", ("", empty.game_data(), "")),
+        "overview_villages_small": screen(small, empty, "overview_villages", small.overview_villages()),
+        "overview_villages_large": screen(large, large.villages[1], "overview_villages", large.overview_villages()),
+        "production_small": screen(small, empty, "overview_villages", small.production_overview(), mode="prod"),
+        "production_large": screen(large, large.villages[1], "overview_villages", large.production_overview(),
+                                   mode="prod"),
+        "production_large_json": screen(large, large.villages[1], "overview_villages", large.production_overview(),
+                                        partial=True, mode="prod"),
+        "ajax_upgrade_success": action(small, empty, "upgrade_building", id="barracks"),
+        "ajax_upgrade_error": action(small, full, "upgrade_building", id="wall"),
+    }
+    for name, page in pages.items():
+        page["file"] = f"{name}.{'json' if page['text'].startswith('{') else 'html'}.gz"
+    return pages
+
+
+def record(pages):
+    """Store the current outputs of every target as the expected outputs."""
+    for page in pages.values():
+        page["expected"] = {name: normalize(name, target(get_response(page))) for name, target in get_targets().items()
+                            if name not in unchecked}
+
+
+def check(pages):
+    """Compare the outputs of every target with the expected outputs. Returns the mismatches."""
+    mismatches = []
+    for page_name, page in pages.items():
+        expected = page.get("expected", {})
+        for name, target in get_targets().items():
+            if name in unchecked:
+                continue
+            if name not in expected:
+                mismatches.append((page_name, name, "no expected output, run with --update"))
+                continue
+
+            actual = normalize(name, target(get_response(page)))
+            if actual != expected[name]:
+                mismatches.append((page_name, name, f"expected {json.dumps(expected[name])[:200]}, "
+                                                    f"got {json.dumps(actual)[:200]}"))
+    return mismatches
+
+
+def measure(target, page, min_time):
+    """Measure the time per call over at least min_time seconds, and the memory that one call allocates at its peak.
+    The memory is measured separately, tracing allocations slows everything down."""
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time:
+        batch = max(1, calls)
+        for _ in range(batch):
+            target(get_response(page))
+        calls += batch
+        elapsed = time.perf_counter() - start
+
+    response = get_response(page)
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    target(response)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"us_per_call": elapsed / calls * 1e6, "calls_per_sec": calls / elapsed, "peak_kb": (peak - before) / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and benchmark the page parser on the corpus of stored pages")
+    parser.add_argument("--page", nargs="+", help="only the pages of which the name contains one of these")
+    parser.add_argument("--method", nargs="+", help="only the methods of which the name contains one of these")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds to measure every method on every page")
+    parser.add_argument("--check-only", action="store_true", help="only check the outputs")
+    parser.add_argument("--update", action="store_true", help="store the current outputs as the expected outputs")
+    parser.add_argument("--generate", action="store_true", help="build the synthetic pages from the mock server")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    # The parser methods record metrics and the web wrapper logs, neither is part of the output
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.generate:
+        pages = generate_corpus()
+        if os.path.exists(INDEX_FILE):
+            # Keep the pages that were added by hand
+            pages = {**load_corpus(), **pages}
+        record(pages)
+        save_corpus(pages)
+        print(f"Generated {len(pages)} pages in {CORPUS_PATH}")
+        return
+
+    pages = load_corpus()
+    if args.update:
+        record(pages)
+        save_corpus(pages)
+        print(f"Recorded the outputs of {len(pages)} pages")
+        return
+
+    def selected(name, filters):
+        return filters is None or any(value in name for value in filters)
+
+    pages = {name: page for name, page in pages.items() if selected(name, args.page)}
+    mismatches = check(pages)
+    for page_name, name, message in mismatches:
+        print(f"MISMATCH {page_name} {name}: {message}", file=sys.stderr)
+
+    if not args.check_only:
+        results = []
+        for page_name, page in pages.items():
+            for name, target in get_targets().items():
+                if selected(name, args.method):
+                    results.append({"page": page_name, "method": name, "kb": len(page["text"]) / 1024,
+                                    **measure(target, page, args.min_time)})
+
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print(f"{'page':<28} {'method':<32} {'KB':>7} {'us/call':>9} {'calls/s':>9} {'peak KB':>8}")
+            for result in results:
+                print(f"{result['page']:<28} {result['method']:<32} {result['kb']:>7.1f} "
+                      f"{result['us_per_call']:>9.1f} {result['calls_per_sec']:>9.0f} {result['peak_kb']:>8.1f}")
+
+    if mismatches:
+        print(f"{len(mismatches)} outputs don't match the expected outputs", file=sys.stderr)
+        sys.exit(1)
+    print(f"All outputs of {len(pages)} pages match", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
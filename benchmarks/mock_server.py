@@ -0,0 +1,372 @@
+"""Local stand-in for a Tribal Wars world. It serves the overview, overview_villages, overview_village and main screens
+for a synthetic account, as full pages or with _partial as json, and accepts the upgrade_building and build_order_reduce
+ajax actions.
+
+The server clock can be shifted with a shared offset, so the benchmark harness can move it along with its virtual clock.
+Request counts and transferred bytes are available from /__stats.
+
+Run it standalone with: python -m benchmarks.mock_server --villages 10 --port 8080
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BUILDINGS = ["main", "barracks", "stable", "garage", "watchtower", "snob", "smith", "place", "statue", "market",
+             "wood", "stone", "iron", "farm", "storage", "wall"]
+
+# Base cost (wood, stone, iron, pop) and build time in seconds of level 1, every level costs `factor` times more
+BASE_COSTS = {
+    "main": (90, 80, 70, 5, 900), "barracks": (200, 170, 90, 7, 1800), "stable": (270, 240, 260, 8, 6000),
+    "garage": (300, 240, 260, 8, 6000), "watchtower": (12000, 14000, 5000, 500, 12000),
+    "snob": (15000, 25000, 10000, 80, 586800), "smith": (220, 180, 240, 20, 6000), "place": (10, 40, 30, 0, 10860),
+    "statue": (220, 220, 220, 10, 1500), "market": (100, 100, 100, 20, 2700), "wood": (50, 60, 40, 5, 900),
+    "stone": (65, 50, 40, 10, 900), "iron": (75, 65, 70, 10, 1080), "farm": (45, 40, 30, 0, 1200),
+    "storage": (60, 50, 40, 0, 1020), "wall": (50, 100, 20, 5, 3600),
+}
+FACTOR = 1.26
+POP_FACTOR = 1.17
+BUILD_TIME_FACTOR = 1.2
+MAX_LEVEL = 30
+
+
+class MockVillage:
+    """State of a single village on the mock server."""
+
+    def __init__(self, village_id, rng, now):
+        self.id = village_id
+        self.name = f"Village {village_id:04d}"
+        self.x = 400 + village_id % 100
+        self.y = 400 + village_id // 100
+        self.levels = {building: rng.randint(0, 10) for building in BUILDINGS}
+        self.levels.update({"main": rng.randint(1, 15), "place": 1, "farm": rng.randint(5, 20),
+                            "storage": rng.randint(5, 20)})
+        self.resources = [float(rng.randint(0, 5000)) for _ in range(3)]
+        self.queue = []
+        self.last_tick = now
+        self.next_order_id = village_id * 1000
+
+    @property
+    def storage_max(self):
+        return math.floor(1000 * 1.2294934 ** (self.levels["storage"] - 1))
+
+    @property
+    def pop_max(self):
+        return math.floor(240 * 1.172103 ** (self.levels["farm"] - 1))
+
+    @property
+    def pop(self):
+        return sum(level * 3 for level in self.levels.values())
+
+    def production(self, building):
+        """Production in resources per second."""
+        level = self.levels[building]
+        return (5 if level == 0 else 30 * 1.163118 ** (level - 1)) / 3600
+
+    def cost(self, building):
+        """Cost of the next level that can be ordered, taking the queue into account."""
+        level = self.levels[building] + sum(1 for order in self.queue if order["building"] == building)
+        wood, stone, iron, pop, build_time = BASE_COSTS[building]
+        multiplier = FACTOR ** level
+        # The population of a level is the total population of the level minus the total of the level before
+        pop_before = round(pop * POP_FACTOR ** (level - 1)) if level > 0 else 0
+        return {
+            "id": building,
+            "level": str(level),
+            "level_next": level + 1,
+            "wood": round(wood * multiplier),
+            "stone": round(stone * multiplier),
+            "iron": round(iron * multiplier),
+            "pop": round(pop * POP_FACTOR ** level) - pop_before,
+            "build_time": math.floor(build_time * BUILD_TIME_FACTOR ** level / 1.05 ** self.levels["main"]),
+        }
+
+    def settle(self, now):
+        """Finish the orders that are done and produce the resources up to now."""
+        for order in list(self.queue):
+            if order["finish"] > now:
+                break
+            self.levels[order["building"]] += 1
+            self.queue.remove(order)
+
+        elapsed = max(0.0, now - self.last_tick)
+        for index, building in enumerate(("wood", "stone", "iron")):
+            self.resources[index] = min(self.storage_max, self.resources[index] + self.production(building) * elapsed)
+        self.last_tick = now
+
+    def game_data(self):
+        wood, stone, iron = self.resources
+        return {
+            "village": {
+                "id": self.id,
+                "name": self.name,
+                "display_name": f"{self.name} ({self.x}|{self.y}) K44",
+                "wood": math.floor(wood),
+                "wood_prod": self.production("wood"),
+                "wood_float": wood,
+                "stone": math.floor(stone),
+                "stone_prod": self.production("stone"),
+                "stone_float": stone,
+                "iron": math.floor(iron),
+                "iron_prod": self.production("iron"),
+                "iron_float": iron,
+                "pop": self.pop,
+                "pop_max": self.pop_max,
+                "x": self.x,
+                "y": self.y,
+                "trader_away": 0,
+                "storage_max": self.storage_max,
+                "bonus_id": None,
+                "bonus": None,
+                "buildings": {building: str(level) for building, level in self.levels.items()},
+                "player_id": 1,
+                "modifications": 0,
+                "points": sum(self.levels.values()) * 10,
+                "last_res_tick": math.floor(self.last_tick * 1000),
+                "coord": f"{self.x}|{self.y}",
+                "is_farm_upgradable": True,
+            },
+            "player": {"id": 1, "name": "benchmark"},
+            "csrf": "mock-csrf",
+        }
+
+    def order(self, building, now):
+        """Order the next level of a building. Returns an error message or None."""
+        if building not in self.levels:
+            return "Unknown building"
+        if len(self.queue) >= 5:
+            return "The queue is full"
+
+        cost = self.cost(building)
+        if any(cost[resource] > self.resources[index] for index, resource in enumerate(("wood", "stone", "iron"))):
+            return "Not enough resources"
+
+        for index, resource in enumerate(("wood", "stone", "iron")):
+            self.resources[index] -= cost[resource]
+
+        start = self.queue[-1]["finish"] if self.queue else now
+        self.next_order_id += 1
+        self.queue.append({"id": self.next_order_id, "building": building, "level": cost["level_next"],
+                           "finish": math.floor(start + cost["build_time"])})
+        return None
+
+    def finish_early(self, order_id, now):
+        """Finish the first order of the queue if it is done within three minutes."""
+        if not self.queue or self.queue[0]["id"] != order_id or self.queue[0]["finish"] - 180 > now:
+            return "Can't finish this order early"
+
+        self.queue[0]["finish"] = now
+        self.settle(now)
+        return None
+
+
+class MockWorld:
+    """A synthetic account with the given number of villages."""
+
+    def __init__(self, villages, page_size=150000, seed=1, clock_offset=None):
+        rng = random.Random(seed)
+        self.clock_offset = clock_offset
+        self.villages = {village_id: MockVillage(village_id, rng, self.now()) for village_id in range(1, villages + 1)}
+        self.filler = "<div class=\"filler\">" + "x" * page_size + "</div>"
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "bytes": 0, "screens": {}}
+
+    def now(self):
+        """Current time of the world, shifted by the shared clock offset if there is one."""
+        if self.clock_offset is None:
+            return time.time()
+        return time.time() + self.clock_offset.value
+
+    def count(self, name, size):
+        self.stats["requests"] += 1
+        self.stats["bytes"] += size
+        self.stats["screens"][name] = self.stats["screens"].get(name, 0) + 1
+
+    def page(self, body, game_data=None, scripts=""):
+        """Wrap a body in the layout that every game page has."""
+        update = f"TribalWars.updateGameData({json.dumps(game_data)});" if game_data else ""
+        header = "".join(
+            f'<a href="/game.php?village={village.id}&amp;screen=overview"><span class="icon header village">'
+            f'</span>{village.name}</a>' for village in list(self.villages.values())[:1])
+        return (
+            '<!DOCTYPE html><html><head><meta content="mock-csrf" name="csrf-token" />'
+            f'<script type="text/javascript">{update}</script></head>'
+            '<body id="ds_body" class="scrollableMenu">'
+            f'<div id="header_info">{header}'
+            '<a href="/game.php?village=1&amp;action=logout&amp;h=abc123">Logout</a></div>'
+            f'<div id="content_value">{body}</div>{self.filler}<script type="text/javascript">{scripts}</script>'
+            '</body></html>')
+
+    def screen(self, village, body, game_data=None, scripts="", partial=False):
+        """Get the content type and text of a screen of the village, as a full page or as json."""
+        if partial:
+            # Like the game loads screens in the background: the content and the game data, without the layout
+            content = f'{body}<script type="text/javascript">{scripts}</script>'
+            return "application/json", json.dumps({"content": content, "game_data": game_data or village.game_data()})
+        return "text/html", self.page(body, game_data, scripts)
+
+    @staticmethod
+    def building_info():
+        """The building config of the world, like interface.php?func=get_building_info."""
+        buildings = []
+        for building, (wood, stone, iron, pop, build_time) in BASE_COSTS.items():
+            config = {
+                "max_level": MAX_LEVEL, "min_level": 0, "wood": wood, "stone": stone, "iron": iron, "pop": pop,
+                "wood_factor": FACTOR, "stone_factor": FACTOR, "iron_factor": FACTOR, "pop_factor": POP_FACTOR,
+                "build_time": build_time, "build_time_factor": BUILD_TIME_FACTOR,
+            }
+            values = "".join(f"<{key}>{value}</{key}>" for key, value in config.items())
+            buildings.append(f"<{building}>{values}</{building}>")
+        return f'<?xml version="1.0" encoding="UTF-8"?><config>{"".join(buildings)}</config>'
+
+    def overview_villages(self):
+        rows = "".join(
+            f'<tr><td><a href="/game.php?village={village.id}&amp;screen=overview"><span class="icon header village">'
+            f'</span>{village.name}</a></td></tr>' for village in self.villages.values())
+        return f'<table id="production_table">{rows}</table>'
+
+    def production_overview(self):
+        rows = ""
+        for village in self.villages.values():
+            village.settle(self.now())
+            wood, stone, iron = (self.number(resource) for resource in village.resources)
+            rows += (
+                f'<tr class="nowrap row_a"><td><span class="quickedit-vn" data-id="{village.id}">'
+                f'<a href="/game.php?village={village.id}&amp;screen=overview"><span class="quickedit-label">'
+                f'{village.name} ({village.x}|{village.y}) K44</span></a></span></td>'
+                f'<td>{self.number(sum(village.levels.values()) * 10)}</td>'
+                f'<td><span class="res wood">{wood}</span> <span class="res stone">{stone}</span> '
+                f'<span class="res iron">{iron}</span></td><td>{village.storage_max}</td>'
+                f'<td><a href="/game.php?village={village.id}&amp;screen=market">0/10</a></td>'
+                f'<td>{village.pop}/{village.pop_max}</td></tr>')
+        return f'<table id="production_table" class="vis overview_table">{rows}</table>'
+
+    @staticmethod
+    def number(value):
+        """Format a number like the game does, with grey dots between the thousands."""
+        return f"{math.floor(value):,}".replace(",", '<span class="grey">.</span>')
+
+    def main(self, village, finish_early_button=True):
+        queue = ""
+        for index, order in enumerate(village.queue):
+            finish_early = ""
+            if index == 0 and finish_early_button:
+                finish_early = (
+                    f'<a class="order_feature btn btn-btr btn-instant-free" href="#" '
+                    f'onclick="BuildingMain.build_order_reduce(this, {order["id"]}, \'BuildInstantFree\'); '
+                    f'return false" data-available-from="{order["finish"] - 180}">Finish</a>')
+            queue += (
+                f'<tr class="lit nodrag buildorder_{order["building"]}"><td class="lit-item">\n'
+                f'<img src="https://dsen.innogamescdn.com/asset/graphic/buildings/mid/{order["building"]}1.png" '
+                f'title="{order["building"]}" class="bmain_list_img" />\n'
+                f'{order["building"].capitalize()}<br />\n    Level {order["level"]}\n'
+                f'</td><td class="lit-item"><span class="" data-endtime="{order["finish"]}">0:00:00</span></td>'
+                f'<td class="lit-item">{finish_early}</td></tr>')
+
+        body = f'<table id="build_queue">{queue}</table>' if queue else ""
+        buildings = {building: village.cost(building) for building in BUILDINGS}
+        return body, village.game_data(), f"BuildingMain.buildings = {json.dumps(buildings)};"
+
+    def handle(self, method, url, form):
+        """Handle a request and return the status code, content type and body."""
+        query = {key: values[0] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+
+        if url.path == "/__stats":
+            return 200, "application/json", json.dumps(self.stats)
+
+        if url.path == "/interface.php" and query.get("func") == "get_building_info":
+            return 200, "text/xml", self.building_info()
+
+        now = self.now()
+        village = self.villages.get(int(query.get("village", 1)))
+        if village is None:
+            return 404, "text/html", "Unknown village"
+        village.settle(now)
+
+        action = query.get("ajaxaction")
+        if action == "upgrade_building":
+            error = village.order(form.get("id"), now)
+        elif action == "build_order_reduce":
+            error = village.finish_early(int(query.get("id", 0)), now)
+        elif action is not None:
+            error = "Unknown action"
+        else:
+            screen = query.get("screen")
+            if screen == "overview_villages" and query.get("mode") == "prod":
+                body, game_data, scripts = self.production_overview(), None, ""
+            elif screen == "overview_villages":
+                body, game_data, scripts = self.overview_villages(), None, ""
+            elif screen == "overview_village":
+                body, game_data, scripts = "", village.game_data(), ""
+            elif screen == "main":
+                body, game_data, scripts = self.main(village)
+            else:
+                body, game_data, scripts = "", None, ""
+
+            return (200, *self.screen(village, body, game_data, scripts, "_partial" in query))
+
+        response = {"error": [error]} if error else {"response": {"success": "OK"}}
+        response["game_data"] = village.game_data()
+        return 200, "application/json", json.dumps(response)
+
+
+def create_server(world, host="127.0.0.1", port=0):
+    """Create a threaded HTTP server for the world. Use port 0 to pick a free port."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately, small responses would otherwise wait for a delayed ack
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.respond({})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            form = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+            self.respond(form)
+
+        def respond(self, form):
+            url = urlparse(self.path)
+            with world.lock:
+                status, content_type, body = world.handle(self.command, url, form)
+                data = body.encode()
+                if not url.path.startswith("/__"):
+                    query = parse_qs(url.query)
+                    name = query.get("ajaxaction", query.get("screen", ["unknown"]))[0]
+                    world.count(name, len(data))
+
+            self.send_response(status)
+            self.send_header("Content-Type", f"{content_type}; charset=UTF-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve(villages, page_size, port, ready=None, clock_offset=None):
+    """Serve a world until the process is stopped. The port is put on the ready queue once the server listens. The
+    clock offset is a shared multiprocessing value with the number of seconds the world runs ahead of real time."""
+    server = create_server(MockWorld(villages, page_size, clock_offset=clock_offset), port=port)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve a synthetic Tribal Wars account")
+    parser.add_argument("--villages", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=150000, help="bytes of filler added to every page")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    print(f"Serving {args.villages} villages on http://127.0.0.1:{args.port}")
+    serve(args.villages, args.page_size, args.port)
@@ -1,22 +1,70 @@
+import argparse
 import logging
+import signal
+import time
 
 import coloredlogs
 
 from src.bot import Bot
 from src.core.config import Config
+from src.core.file_manager import FileManager
+from src.core.profiler import Profiler
+from src.core.state_store import StateStore
+from src.supervisor import Supervisor
 
 coloredlogs.install(level=logging.INFO, fmt="%(asctime)s %(name)s %(levelname)s: %(message)s")
 logger = logging.getLogger("Main")
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+
+def stop(signum, frame):
+    raise SystemExit(0)
+
+
 if __name__ == '__main__':
-    config = Config()
-    log_level = config.get("bot.log_level", "INFO")
-    coloredlogs.set_level(log_level)
-    bot = Bot(config)
+    parser = argparse.ArgumentParser(description="Tribal Wars bot")
+    parser.add_argument("--workspace", help="directory for the config and data of this account")
+    parser.add_argument("--supervisor", action="store_true", help="run all accounts of accounts.yaml")
+    parser.add_argument("--profile", type=int, metavar="CYCLES",
+                        help="profile this many cycles and write the results to data/profiles")
+    parser.add_argument("--profile-target", choices=["cycle", "village"], default="cycle",
+                        help="profile whole cycles or every village run on its own")
+    parser.add_argument("--report", type=int, metavar="HOURS",
+                        help="print the actions per hour and the resources of the villages of the last hours from the "
+                             "state store")
+    args = parser.parse_args()
+
+    # docker stop and systemd stop the bot with SIGTERM, which would otherwise end the process without running the exit
+    # handlers and lose the changes to the config that are still written behind
+    signal.signal(signal.SIGTERM, stop)
+
     try:
-        bot.start()
+        if args.supervisor:
+            Supervisor().start()
+
+        if args.workspace:
+            FileManager.set_workspace(args.workspace)
+            FileManager.create_directory("")
+
+        config = Config()
+        log_level = config.get("bot.log_level", "INFO")
+        coloredlogs.set_level(log_level)
+        if args.report:
+            store = StateStore.open(config)
+            if store is None:
+                logger.error("The state store is disabled, enable bot.state_store to keep a history")
+                exit(1)
+            villages = [(village["id"], village["name"]) for village in config.get("villages", [])]
+            print("\n".join(store.report(villages, time.time() - args.report * 3600)))
+            exit(0)
+
+        bot = Bot(config)
+        if args.profile:
+            Profiler(args.profile_target).install(bot)
+            bot.start(cycles=args.profile)
+        else:
+            bot.start()
     except KeyboardInterrupt:
         logger.info("Exiting...")
         exit(0)
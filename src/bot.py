@@ -1,46 +1,278 @@
 import copy
+import dataclasses
+import itertools
 import logging
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+from src.core import metrics
+from src.core.bootstrap import bootstrap
 from src.core.config import Config
+from src.core.events import subscribe_event, publish_event, deliver_queued_events, Event
 from src.core.file_manager import FileManager
 from src.core.input import Input
+from src.core.metrics import MetricsExporter
 from src.core.page_parser import PageParser
+from src.core.quarantine import SessionQuarantined
+from src.core.request_controller import RequestFailed
+from src.core.scheduler import Scheduler
+from src.core.state_store import StateStore
 from src.core.time_utils import TimeUtils
-from src.core.web_wrapper import WebWrapper
+from src.core.web_wrapper import WebWrapper, SessionExpired
 from src.game.village import Village
+from src.model.village import VillageData
 
 logger = logging.getLogger("Bot")
 
 
 class Bot:
     villages: [Village] = []
+    restoring: bool = False
 
     def __init__(self, config: Config):
         self.config = config
         self.web = WebWrapper(self.config)
 
         self.setup_environment()
+        self.store = StateStore.open(self.config)
+        self.metrics_exporter = MetricsExporter.start(self.config)
+        if self.store is not None:
+            # Snapshots are recorded when the store is flushed, not in the middle of a village run
+            subscribe_event(Event.VILLAGE_DATA_UPDATE, self._on_village_data_update, queued=True)
 
-    def start(self):
+    def _on_village_data_update(self, village_data: VillageData):
+        # Restored data is already in the store
+        if not self.restoring:
+            self.store.record_snapshot(village_data)
+
+    def start(self, cycles=None):
+        """Run the bot. If cycles is given, stop after that many runs of the villages (used by the profiling mode)."""
         logger.info("Bot started")
 
         self.villages = self.get_villages()
+        self.restore_villages()
 
-        while True:
-            for village in self.villages:
-                village.run()
-                sleep_time_village = self.config.get("bot.delays.between_villages", 5)
-                logger.info(f"Sleeping for {sleep_time_village} seconds")
-                TimeUtils.sleep(sleep_time_village)
+        if self.config.get("bot.scheduler.enabled", False):
+            self.run_scheduled(cycles)
+            return
+
+        for cycle in itertools.count(1):
+            self.run_cycle()
+            if cycle == cycles:
+                return
 
             sleep_time_runs = self.config.get("bot.delays.between_runs", 180)
+            if self.web.quarantine.active:
+                # The villages that were parked run as soon as the session is resumed
+                self.sleep_while_quarantined(sleep_time_runs)
+                continue
+
             logger.info(f"Sleeping for {sleep_time_runs} seconds")
             TimeUtils.sleep(sleep_time_runs)
 
+    def run_cycle(self):
+        """Run all villages once."""
+        with metrics.cycle_seconds.time():
+            try:
+                if self.config.get("bot.bulk_refresh.enabled", False):
+                    try:
+                        self.refresh_villages()
+                    except RequestFailed as e:
+                        logger.error(f"Refreshing villages failed: {e}")
+
+                workers = self.config.get("bot.workers", 1)
+                if workers > 1:
+                    self.run_villages_concurrently(workers)
+                else:
+                    self.run_villages()
+            except SessionQuarantined:
+                logger.warning("Session quarantined, the rest of the cycle is parked")
+            self.flush_store()
+
+    def run_villages(self):
+        """Run the villages one after another, sleeping after every run that made requests. Villages without work are
+        skipped without a sleep."""
+        for village in self.villages:
+            request_count = self.web.request_count
+            try:
+                village.run()
+            except RequestFailed as e:
+                logger.error(f"Village run failed: {e}")
+            if self.web.request_count == request_count:
+                continue
+
+            sleep_time_village = self.config.get("bot.delays.between_villages", 5)
+            logger.info(f"Sleeping for {sleep_time_village} seconds")
+            TimeUtils.sleep(sleep_time_village)
+
+    def run_villages_concurrently(self, workers, villages=None):
+        """Run the villages on a pool of workers. Pacing is left to the rate limiter of the web wrapper. Returns for
+        every village whether its run failed."""
+        villages = self.villages if villages is None else villages
+        logger.info(f"Running {len(villages)} villages with {workers} workers")
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Village") as executor:
+            futures = [executor.submit(village.run) for village in villages]
+
+        failed = []
+        for village, future in zip(villages, futures):
+            exception = future.exception()
+            if isinstance(exception, SessionExpired):
+                # Nothing can run without new cookies
+                raise exception
+            if isinstance(exception, SessionQuarantined):
+                logger.info(f"Village {village.village_id} parked: {exception}")
+            elif exception is not None:
+                logger.error(f"Village run failed: {exception}")
+            failed.append(exception is not None)
+        return failed
+
+    def run_scheduled(self, cycles=None):
+        """Run villages only when they have something to do, sleeping until the earliest deadline in between. If
+        cycles is given, stop after that many runs of due villages."""
+        scheduler = Scheduler()
+        for village in self.villages:
+            scheduler.schedule(village, time.time())
+
+        refresh_enabled = self.config.get("bot.bulk_refresh.enabled", False)
+        refresh_interval = self.config.get("bot.bulk_refresh.interval", 600)
+        next_refresh_at = time.time()
+
+        # Villages that need the session while it is quarantined, they are scheduled again when it is resumed
+        parked = []
+        cycle = 0
+        while True:
+            quarantined = self.web.quarantine.poll()
+            if parked and not quarantined:
+                logger.info(f"Session resumed, running {len(parked)} parked villages")
+                for village in parked:
+                    scheduler.schedule(village, time.time())
+                parked = []
+
+            if refresh_enabled and not quarantined and time.time() >= next_refresh_at:
+                try:
+                    self.refresh_villages()
+                    next_refresh_at = time.time() + refresh_interval
+                except SessionQuarantined:
+                    # The refresh is done as soon as the session is resumed
+                    logger.warning("Session quarantined, the refresh is parked")
+                except RequestFailed as e:
+                    logger.error(f"Refreshing villages failed: {e}")
+                    next_refresh_at = time.time() + refresh_interval
+                finally:
+                    self.flush_store()
+
+            wake_at = [next_refresh_at] if refresh_enabled else []
+            if self.web.quarantine.active:
+                # Check for the resume every poll interval, in between the deadlines of the villages
+                wake_at.append(time.time() + self.web.quarantine.poll_interval)
+            elif not scheduler and not wake_at:
+                # Nothing is scheduled, so there is no deadline to wake up for
+                wake_at.append(time.time() + self.config.get("bot.delays.between_runs", 180))
+            scheduler.sleep_until_next(min(wake_at, default=None))
+
+            due = scheduler.pop_due()
+            if not due:
+                continue
+            if self.web.quarantine.active:
+                logger.info(f"Session quarantined, {len(due)} villages are parked")
+                parked.extend(due)
+                continue
+
+            parked.extend(self.run_due(scheduler, due))
+            cycle += 1
+            if cycle == cycles:
+                return
+
+            if scheduler:
+                next_run_in = max(0, round(scheduler.next_run_at() - time.time()))
+                logger.info(f"Next village run in {next_run_in} seconds")
+
+    def run_due(self, scheduler, due):
+        """Run the due villages and schedule their next run. Returns the villages that failed because the session was
+        quarantined, these aren't scheduled."""
+        parked = []
+        with metrics.cycle_seconds.time():
+            workers = self.config.get("bot.workers", 1)
+            failed = self.run_villages_concurrently(workers, due)
+            for village, has_failed in zip(due, failed):
+                if has_failed and self.web.quarantine.active:
+                    parked.append(village)
+                else:
+                    scheduler.schedule(village, self.get_next_run_at(village, has_failed))
+            self.flush_store()
+        return parked
+
+    def get_next_run_at(self, village, failed=False):
+        """Get the unix timestamp at which the village should run next, clamped to the configured delays."""
+        now = time.time()
+        if failed:
+            return now + self.config.get("bot.delays.between_runs", 180)
+
+        min_delay = self.config.get("bot.scheduler.min_delay", 5)
+        max_delay = self.config.get("bot.scheduler.max_delay", 3600)
+        margin = self.config.get("bot.scheduler.margin", 2)
+        next_run_at = village.next_run_at(now + max_delay) + margin
+        return min(max(next_run_at, now + min_delay), now + max_delay)
+
+    def sleep_while_quarantined(self, seconds):
+        """Sleep for the given number of seconds, or until the session is resumed if that comes first."""
+        logger.info(f"Session quarantined, checking every {self.web.quarantine.poll_interval} seconds whether it is "
+                    f"resumed")
+        until = time.time() + seconds
+        while time.time() < until and self.web.quarantine.poll():
+            time.sleep(self.web.quarantine.poll_interval)
+
+    def restore_villages(self):
+        """Restore the last known state of the villages from the state store, so that villages without work aren't
+        fetched right after a restart."""
+        if self.store is None:
+            return
+
+        self.restoring = True
+        try:
+            restored = 0
+            for village in self.villages:
+                snapshot, building_queue, state = self.store.load_village(village.village_id)
+                village_data = VillageData.from_json(snapshot) if snapshot is not None else None
+                village.restore(village_data, building_queue, state)
+                restored += snapshot is not None
+            deliver_queued_events()
+        finally:
+            self.restoring = False
+        logger.info(f"Restored {restored}/{len(self.villages)} villages from the state store")
+
+    def flush_store(self):
+        """Write everything that changed during the cycle to the state store at once."""
+        deliver_queued_events()
+        if self.store is not None:
+            self.store.flush()
+
+    def refresh_villages(self):
+        """Refresh the resources, storage and population of all villages from the production overview. This costs one
+        request for the whole account instead of one per village."""
+        logger.info("Refreshing villages")
+        response = self.web.get_screen("overview_villages", params={"mode": "prod"}, required=("village_resources",))
+        overview = PageParser.get_village_resources(response)
+        last_res_tick = math.floor(time.time() * 1000)
+
+        for village in self.villages:
+            data = overview.get(village.village_id)
+            if data is None or village.village_data is None:
+                # Villages that were never run have no full snapshot to update yet
+                continue
+
+            village.village_data = dataclasses.replace(village.village_data, last_res_tick=last_res_tick, **data)
+            publish_event(Event.VILLAGE_DATA_UPDATE, village.village_data, key=village.village_id)
+            village.log_info()
+
     def get_villages(self):
-        logger.info("Getting villages")
-        result = self.web.get_screen("overview_villages")
-        villages = PageParser.get_villages_from_overview(result)
+        try:
+            villages = self.get_village_list()
+        except SessionQuarantined:
+            # New villages are found by the next start
+            logger.warning("Session quarantined, using the villages of the config")
+            villages = []
 
         # Remove villages that are already in the config
         config_villages = self.config.get("villages", [])
@@ -53,7 +285,13 @@ class Bot:
         # Should we manage new villages?
         auto_manage = self.config.get("bot.auto_manage_new_villages", False)
         for village_id, village_name in new_villages:
-            should_manage = auto_manage or Input.ask_bool(f"Manage village \"{village_name}\"?")
+            if auto_manage:
+                should_manage = True
+            elif Input.interactive:
+                should_manage = Input.ask_bool(f"Manage village \"{village_name}\"?")
+            else:
+                logger.warning(f"New village \"{village_name}\" is not managed until manage is set in the config")
+                should_manage = False
             new_village = copy.deepcopy(self.config.get("village_template"))
             new_village.update({
                 "id": village_id,
@@ -63,10 +301,39 @@ class Bot:
             config_villages.append(new_village)
 
         # Save the new villages to the config
-        self.config.set("villages", config_villages)
+        if new_villages:
+            self.config.set("villages", config_villages)
+
+        # Create Village objects for the managed villages
+        managed_villages = [village_config for village_config in config_villages if village_config.get("manage")]
+        if len(managed_villages) < len(config_villages):
+            logger.info(f"{len(config_villages) - len(managed_villages)} villages are not managed")
+        return [Village(village_config, self.config, self.web, self.store) for village_config in managed_villages]
+
+    def get_village_list(self):
+        """Get the (id, name) of every village of the account. On a warm start the list of the bootstrap snapshot is
+        used, new villages are then found by the next start after bot.warm_start.max_age."""
+        if self.config.get("bot.warm_start.enabled", True):
+            cached = bootstrap.get_fresh("villages", self.config.get("bot.warm_start.max_age", 3600),
+                                         base_url=self.web.base_url)
+            if cached is not None:
+                logger.info(f"Using the {len(cached['villages'])} villages of the last start")
+                return [tuple(village) for village in cached["villages"]]
+
+        logger.info("Getting villages")
+        result = self.web.get_screen("overview_villages", required=("villages",))
+        villages = PageParser.get_villages_from_overview(result)
+        bootstrap.set_fresh("villages", base_url=self.web.base_url, villages=villages)
+        return villages
 
-        # Create Village objects
-        return [Village(village_config, self.config, self.web) for village_config in config_villages]
+    def health(self):
+        """Get the counters that a supervisor uses to follow this bot."""
+        return {
+            "villages": len(self.villages),
+            "village_runs": sum(village.run_count for village in self.villages),
+            "requests": self.web.request_count,
+            "quarantined": self.web.quarantine.active,
+        }
 
     @staticmethod
     def setup_environment():
@@ -0,0 +1,67 @@
+import logging
+import os
+import threading
+import time
+
+from src.core.file_manager import FileManager, write_behind
+
+logger = logging.getLogger("Bootstrap")
+
+
+class Bootstrap:
+    """Snapshot of what a start needs that is slow to get: a copy of the config, the version of the example config,
+    when the session was last known to be valid and the list of villages. It is a json file in the data directory of
+    the workspace, so a warm start needs no yaml parsing and no requests. Changes are written behind."""
+    file_path = os.path.join("data", "bootstrap.json")
+
+    def __init__(self):
+        self.values = None
+        self.root = None
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Load the snapshot of the current workspace, once."""
+        root = FileManager.get_root_path()
+        if self.values is not None and self.root == root:
+            return self.values
+
+        self.root = root
+        try:
+            self.values = FileManager.load_json_file(self.file_path) or {}
+        except ValueError as e:
+            logger.warning(f"Ignoring invalid {self.file_path}: {e}")
+            self.values = {}
+        return self.values
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.load().get(key, default)
+
+    def get_fresh(self, key, max_age, **expected):
+        """Get a value that was set with set_fresh at most max_age seconds ago and with the expected fields, or None."""
+        value = self.get(key)
+        if value is None or time.time() - value.get("time", 0) > max_age:
+            return None
+        if any(value.get(field) != expected_value for field, expected_value in expected.items()):
+            return None
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.load()[key] = value
+            # The workspace is resolved now, the file may be written after it changed
+            full_path = os.path.join(self.root, self.file_path)
+            values = self.values
+        write_behind.schedule(full_path, lambda: self.save(full_path, values))
+
+    def set_fresh(self, key, **value):
+        """Set a value with the current time, for get_fresh."""
+        self.set(key, {**value, "time": time.time()})
+
+    def save(self, full_path, values):
+        with self.lock:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            FileManager.save_json_file(full_path, values)
+
+
+bootstrap = Bootstrap()
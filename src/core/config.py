@@ -1,19 +1,37 @@
+import json
 import logging
+import threading
 
-from src.core.file_manager import FileManager
+from src.core.bootstrap import bootstrap
+from src.core.file_manager import FileManager, write_behind
 from src.core.input import Input
 
 logger = logging.getLogger("Config")
 
+_missing = object()
+
 
 class Config:
-    """Class for handling the config file."""
+    """Class for handling the config file. Changes are written behind: the file is saved at most once every few
+    seconds with all changes since the last save, and at exit.
+
+    Reading config.yaml with ruamel is slow, so a json copy of it is kept in the bootstrap snapshot. While the file is
+    unchanged the copy is used, and the yaml document (which keeps the comments and formatting) is only loaded to make
+    a change."""
     config_file = "config.yaml"
     config_file_example = "config.example.yaml"
 
-    def __init__(self):
-        """Load the config file or create a new one if it doesn't exist."""
-        if FileManager.path_exists(self.config_file):
+    def __init__(self, config=None):
+        """Load the config file or create a new one if it doesn't exist. If a config (a dict or a loaded yaml document)
+        is given, it is used as is and no file is read."""
+        self.path_cache = {}
+        self.village_index = None
+        # Held while the config is changed or saved, so a save never sees half a change
+        self.lock = threading.RLock()
+        self.document = None
+        if config is not None:
+            self.config = self.document = config
+        elif FileManager.path_exists(self.config_file):
             logger.info("Loading config file")
             self.config = self.load_config()
         else:
@@ -22,15 +40,34 @@ class Config:
 
     def load_config(self):
         """Load the config file and update it if it's outdated."""
-        old_config = FileManager.load_yaml_file(self.config_file)
-        new_config = FileManager.load_yaml_file(self.config_file_example)
+        cached = bootstrap.get("config")
+        if cached is not None and cached["modified_time"] == FileManager.get_modified_time(self.config_file):
+            config = cached["data"]
+        else:
+            config = self.document = FileManager.load_yaml_file(self.config_file)
 
         # Check if the config file is outdated
-        if old_config["version"] < new_config["version"]:
+        if config["version"] < self.get_example_version():
             logger.warning("Config file is outdated, updating it")
-            old_config = self.update_config(old_config, new_config)
+            self.config = config
+            self.load_document()
+            return self.update_config(self.document, FileManager.load_yaml_file(self.config_file_example))
 
-        return old_config
+        if self.document is not None:
+            self.config = config
+            self.cache()
+        return config
+
+    def get_example_version(self):
+        """Get the version of the example config, which is kept in the bootstrap snapshot until the file changes."""
+        modified_time = FileManager.get_modified_time(self.config_file_example)
+        cached = bootstrap.get("config_example")
+        if cached is not None and cached["modified_time"] == modified_time:
+            return cached["version"]
+
+        version = FileManager.load_yaml_file(self.config_file_example)["version"]
+        bootstrap.set("config_example", {"modified_time": modified_time, "version": version})
+        return version
 
     def update_config(self, old_config, new_config):
         """Update the config file with new values."""
@@ -40,68 +77,109 @@ class Config:
             elif isinstance(value, dict):
                 old_config[key] = self.update_config(old_config[key], value)
 
-        old_config["version"] = new_config["version"]
-        FileManager.save_yaml_file(self.config_file, old_config)
+        if "version" in new_config:
+            old_config["version"] = new_config["version"]
+            write_behind.schedule(self.config_file, self.save)
         return old_config
 
     def create_config(self):
         """Create a new config file."""
         config = FileManager.load_yaml_file(self.config_file_example)
 
-        config.update({
-            "web": {
-                "server": Input.ask_string("Enter the server", "nl95"),
-                "domain": Input.ask_string("Enter the domain", "tribalwars.nl"),
-                "user-agent": Input.ask_string("Enter the user agent",
-                                               "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, "
-                                               "like Gecko) Chrome/121.0.0.0 Safari/537.36")
-            },
+        config.setdefault("web", {}).update({
+            "server": Input.ask_string("Enter the server", "nl95"),
+            "domain": Input.ask_string("Enter the domain", "tribalwars.nl"),
+            "user-agent": Input.ask_string("Enter the user agent",
+                                           "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, "
+                                           "like Gecko) Chrome/121.0.0.0 Safari/537.36")
         })
 
         FileManager.save_yaml_file(self.config_file, config)
+        self.config = self.document = config
+        self.cache()
         return config
 
-    def get_village(self, village_id, path, default=None):
-        """Get a village from the config file."""
-        villages = self.get("villages")
-        value = None
-        for village in villages:
-            if village["id"] == village_id:
-                value = village
-
-        if value is None:
-            raise KeyError(f"Village with id {village_id} not found in config")
-
-        keys = path.split('.')
+    def load_document(self):
+        """Load the yaml document of the config if the config was read from the bootstrap snapshot, so it can be
+        changed without losing its comments and formatting."""
+        with self.lock:
+            if self.document is None:
+                self.document = FileManager.load_yaml_file(self.config_file)
+                self.config = self.document
+                self.invalidate()
+
+    def cache(self):
+        """Keep a json copy of the config as it is on disk in the bootstrap snapshot."""
+        bootstrap.set("config", {"modified_time": FileManager.get_modified_time(self.config_file),
+                                 "data": json.loads(json.dumps(self.config))})
+
+    def save(self):
+        """Write the config file now."""
+        with self.lock:
+            FileManager.save_yaml_file(self.config_file, self.config)
+            self.cache()
+
+    def flush(self):
+        """Write the config file now if it has changes that weren't saved yet."""
+        write_behind.flush()
+
+    def invalidate(self):
+        """Clear the cached lookups, they are rebuilt on the next read."""
+        self.path_cache = {}
+        self.village_index = None
+
+    @staticmethod
+    def lookup(value, keys):
+        """Walk the keys from value. Returns the value or the first missing key."""
         for key in keys:
             if key not in value:
-                if default is not None:
-                    return default
-                raise KeyError(f"Path {path} not found in village({village_id}) config (missing key {key})")
+                return _missing, key
             value = value[key]
+        return value, None
+
+    def get_village(self, village_id, path, default=None):
+        """Get a village from the config file."""
+        if self.village_index is None:
+            self.village_index = {village["id"]: village for village in self.get("villages", [])}
+
+        cache_key = ("villages", village_id, path)
+        if cache_key not in self.path_cache:
+            village = self.village_index.get(village_id)
+            if village is None:
+                raise KeyError(f"Village with id {village_id} not found in config")
+            self.path_cache[cache_key] = self.lookup(village, path.split('.'))
+
+        value, missing_key = self.path_cache[cache_key]
+        if value is _missing:
+            if default is not None:
+                return default
+            raise KeyError(f"Path {path} not found in village({village_id}) config (missing key {missing_key})")
 
         return value
 
     def get(self, path, default=None):
         """Get a value from the config file. If the value doesn't exist, return the default value or a KeyError."""
-        keys = path.split('.')
-        value = self.config
-        for key in keys:
-            if key not in value:
-                if default is not None:
-                    return default
-                raise KeyError(f"Path {path} not found in config (missing key {key})")
-            value = value[key]
+        if path not in self.path_cache:
+            self.path_cache[path] = self.lookup(self.config, path.split('.'))
+
+        value, missing_key = self.path_cache[path]
+        if value is _missing:
+            if default is not None:
+                return default
+            raise KeyError(f"Path {path} not found in config (missing key {missing_key})")
         return value
 
     def set(self, path, value):
         """Set a value in the config file. If the path doesn't exist, create it."""
         keys = path.split('.')
-        config = self.config
-        for key in keys[:-1]:
-            if key not in config:
-                config[key] = {}
-            config = config[key]
-        config[keys[-1]] = value
-        FileManager.save_yaml_file(self.config_file, self.config)
+        with self.lock:
+            self.load_document()
+            config = self.config
+            for key in keys[:-1]:
+                if key not in config:
+                    config[key] = {}
+                config = config[key]
+            config[keys[-1]] = value
+            self.invalidate()
+        write_behind.schedule(self.config_file, self.save)
         return value
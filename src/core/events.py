@@ -1,19 +1,68 @@
-from collections import defaultdict
+import threading
+import types
+import weakref
+from collections import defaultdict, deque
 from enum import Enum
 
+# Subscriptions by (event, key), a key of None receives the event for every key
 subscribers = defaultdict(list)
+# Deliveries to queued subscriptions that wait for deliver_queued_events
+queued_deliveries = deque()
+lock = threading.Lock()
 
 
 class Event(Enum):
     VILLAGE_DATA_UPDATE = 1
 
 
-def subscribe_event(event: Event, callback):
-    """Subscribe to an event."""
-    subscribers[event].append(callback)
+class Subscription:
+    """Subscription to an event. Bound methods are referenced weakly, so a subscriber that is gone is dropped instead of
+    being kept alive by the subscription."""
 
+    def __init__(self, callback, queued):
+        if isinstance(callback, types.MethodType):
+            self.reference = weakref.WeakMethod(callback)
+        else:
+            self.reference = lambda: callback
+        self.queued = queued
 
-def publish_event(event: Event, data=None):
-    """Publish an event."""
-    for subscriber in subscribers[event]:
-        subscriber(data)
+    def get_callback(self):
+        return self.reference()
+
+
+def subscribe_event(event: Event, callback, key=None, queued=False):
+    """Subscribe to an event. With a key (like a village id) only the events published for that key are received,
+    without a key all of them are. Queued subscriptions receive the events when deliver_queued_events is called
+    instead of during publish_event."""
+    with lock:
+        subscribers[(event, key)].append(Subscription(callback, queued))
+
+
+def publish_event(event: Event, data=None, key=None):
+    """Publish an event to the subscribers of its key and the subscribers of all keys. Only these subscriptions are
+    looked at, so the cost doesn't grow with the number of subscribers for other keys."""
+    for subscription_key in (key, None) if key is not None else (None,):
+        subscriptions = subscribers.get((event, subscription_key))
+        if not subscriptions:
+            continue
+
+        for subscription in tuple(subscriptions):
+            callback = subscription.get_callback()
+            if callback is None:
+                with lock:
+                    if subscription in subscriptions:
+                        subscriptions.remove(subscription)
+            elif subscription.queued:
+                queued_deliveries.append((callback, data))
+            else:
+                callback(data)
+
+
+def deliver_queued_events():
+    """Deliver the events that are waiting for queued subscriptions, in the order they were published."""
+    while True:
+        try:
+            callback, data = queued_deliveries.popleft()
+        except IndexError:
+            return
+        callback(data)
@@ -1,20 +1,86 @@
+import atexit
 import json
+import logging
 import os
+import threading
 
 from ruamel.yaml import YAML
 
 yaml = YAML()
 yaml.preserve_quotes = True
 
+logger = logging.getLogger("FileManager")
+
+
+class WriteBehind:
+    """Coalesces the saves of files. A save is only scheduled, and every file is written once with its latest state at
+    most `interval` seconds later, or when flush is called. Pending saves are flushed when the interpreter exits."""
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.pending = {}
+        self.timer = None
+        # Reentrant, so a flush on SIGTERM can't deadlock on a schedule that the signal interrupted
+        self.lock = threading.RLock()
+        atexit.register(self.flush)
+
+    def schedule(self, file_path, save):
+        """Schedule a save of the file, save is called without arguments to write it. A save that is already pending
+        for the file is replaced."""
+        with self.lock:
+            self.pending[file_path] = save
+            if self.timer is None:
+                self.timer = threading.Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """Write every pending file now."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        for file_path, save in pending.items():
+            try:
+                save()
+            except OSError as e:
+                logger.error(f"Failed to save {file_path}: {e}")
+
+
+write_behind = WriteBehind()
+
 
 class FileManager:
-    """Class to manage file operations. All the operations are ran from the root path of the project."""
+    """Class to manage file operations. All the operations are ran from the root path, which is the project unless a
+    workspace is set. Strategies and yaml files that are only read (like the example config) fall back to the project
+    when the workspace doesn't have them. Data files never do, so workspaces can't share them."""
+    workspace_path = None
 
     @staticmethod
-    def get_root_path():
-        """Get the root path of the project."""
+    def get_project_path():
+        """Get the path of the project."""
         return os.path.join(os.path.dirname(__file__), "..", "..")
 
+    @staticmethod
+    def get_root_path():
+        """Get the root path, the workspace if one is set or otherwise the project."""
+        return FileManager.workspace_path or FileManager.get_project_path()
+
+    @staticmethod
+    def set_workspace(workspace_path):
+        """Use a separate directory for the config and data of this process, for running multiple accounts."""
+        FileManager.workspace_path = os.path.abspath(workspace_path)
+
+    @staticmethod
+    def get_read_path(file_path):
+        """Get the full path to read a file from, falling back to the project if the root doesn't have the file."""
+        full_path = os.path.join(FileManager.get_root_path(), file_path)
+        if not os.path.exists(full_path):
+            return os.path.join(FileManager.get_project_path(), file_path)
+        return full_path
+
     @staticmethod
     def create_directory(directory_path):
         """Create a directory."""
@@ -22,16 +88,33 @@ class FileManager:
         if not os.path.exists(full_path):
             os.makedirs(full_path)
 
+    @staticmethod
+    def remove_file(file_path):
+        """Remove a file if it exists."""
+        full_path = os.path.join(FileManager.get_root_path(), file_path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+
     @staticmethod
     def path_exists(file_path):
         """Check if a file exists."""
         full_path = os.path.join(FileManager.get_root_path(), file_path)
         return os.path.exists(full_path)
 
+    @staticmethod
+    def get_modified_time(file_path):
+        """Get the last modification time of a file, or None if it doesn't exist."""
+        full_path = FileManager.get_read_path(file_path)
+
+        if not os.path.exists(full_path):
+            return None
+
+        return os.path.getmtime(full_path)
+
     @staticmethod
     def read_lines(file_path):
         """Read a text file."""
-        full_path = os.path.join(FileManager.get_root_path(), file_path)
+        full_path = FileManager.get_read_path(file_path)
 
         if not os.path.exists(full_path):
             return None
@@ -42,7 +125,7 @@ class FileManager:
     @staticmethod
     def load_yaml_file(file_path):
         """Load a yaml file."""
-        full_path = os.path.join(FileManager.get_root_path(), file_path)
+        full_path = FileManager.get_read_path(file_path)
 
         if not os.path.exists(full_path):
             return None
@@ -50,12 +133,28 @@ class FileManager:
         with open(full_path, 'r') as file:
             return yaml.load(file)
 
+    @staticmethod
+    def write_atomic(file_path, write):
+        """Write a file through a temporary file next to it that replaces it, so the file is never half written, not
+        even when the process crashes. write is called with the open temporary file."""
+        full_path = os.path.join(FileManager.get_root_path(), file_path)
+        # Unique per thread, so threads that save the same file don't write to the same temporary file
+        temporary_path = f"{full_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_path, 'w') as file:
+                write(file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary_path, full_path)
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
     @staticmethod
     def save_yaml_file(file_path, data):
         """Save a yaml file."""
-        full_path = os.path.join(FileManager.get_root_path(), file_path)
-        with open(full_path, 'w') as file:
-            yaml.dump(data, file)
+        FileManager.write_atomic(file_path, lambda file: yaml.dump(data, file))
 
     @staticmethod
     def load_json_file(file_path):
@@ -71,6 +170,4 @@ class FileManager:
     @staticmethod
     def save_json_file(file_path, data):
         """Save a json file."""
-        full_path = os.path.join(FileManager.get_root_path(), file_path)
-        with open(full_path, 'w') as file:
-            json.dump(data, file, indent=2)
+        FileManager.write_atomic(file_path, lambda file: json.dump(data, file, indent=2))
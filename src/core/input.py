@@ -5,6 +5,8 @@ logger = logging.getLogger("Input")
 
 class Input:
     """Class for handling user input."""
+    # Whether there is a user to ask, supervised workers have no stdin
+    interactive = True
 
     @staticmethod
     def ask_string(question: str, default=None, example=None) -> str:
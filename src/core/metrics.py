@@ -0,0 +1,190 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.core.file_manager import FileManager
+
+logger = logging.getLogger("Metrics")
+
+# Upper bounds in seconds, from a fast regex search up to a slow request
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+registry = []
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    labels = [*key, *extra]
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    """Counter that only goes up, per combination of labels."""
+    type = "counter"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            return [f"{self.name}{format_labels(key)} {value}" for key, value in sorted(self.values.items())]
+
+
+class Histogram:
+    """Histogram with fixed buckets per combination of labels. Observing is a binary search and an increment."""
+    type = "histogram"
+
+    def __init__(self, name, description, buckets=default_buckets):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.values = {}  # label key -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            values[0][index] += 1
+            values[1] += value
+            values[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels):
+        """Decorator that observes the time spent in the function."""
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+
+            return wrapper
+
+        return decorator
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+
+request_seconds = Histogram("twb_request_seconds", "Latency of web requests by screen or ajax action")
+received_bytes = Counter("twb_received_bytes_total", "Bytes of response bodies received by screen or ajax action")
+requests_total = Counter("twb_requests_total", "Web requests by screen or ajax action")
+parse_seconds = Histogram("twb_parse_seconds", "Time spent in the page parser by method")
+find_next_task_seconds = Histogram("twb_find_next_task_seconds", "Time spent finding the next building task")
+village_runs_total = Counter("twb_village_runs_total", "Village runs that fetched the village")
+village_run_seconds = Histogram("twb_village_run_seconds", "Duration of village runs",
+                                buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+cycle_seconds = Histogram("twb_cycle_seconds", "Duration of a run of all (or all due) villages, including sleeps",
+                          buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+sleep_seconds = Counter("twb_sleep_seconds_total", "Seconds spent sleeping by reason")
+captchas_total = Counter("twb_captchas_total", "Captchas that were detected")
+retries_total = Counter("twb_retries_total", "Requests that were retried by screen or ajax action")
+circuit_opened_total = Counter("twb_circuit_opened_total", "Times the circuit of a screen or ajax action opened")
+session_expired_total = Counter("twb_session_expired_total", "Requests that ran into an expired session")
+
+
+def render():
+    """Render all metrics in the Prometheus text format."""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsExporter:
+    """Writes the metrics to a Prometheus text file every interval seconds, and serves them on a local endpoint if a
+    port is configured."""
+
+    def __init__(self, file_path, interval, port):
+        self.file_path = file_path
+        self.interval = interval
+        self.server = None
+
+        if file_path:
+            threading.Thread(target=self.write_forever, name="Metrics", daemon=True).start()
+
+        if port:
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+            threading.Thread(target=self.server.serve_forever, name="MetricsServer", daemon=True).start()
+            logger.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+    @staticmethod
+    def start(config):
+        """Start the exporter configured with bot.metrics, or return None if it's disabled."""
+        if not config.get("bot.metrics.enabled", False):
+            return None
+
+        return MetricsExporter(config.get("bot.metrics.file", "data/metrics.prom"),
+                               config.get("bot.metrics.interval", 60),
+                               config.get("bot.metrics.port", 0))
+
+    def write(self):
+        """Write the metrics to the file. The file is replaced at once, so readers never see half of it."""
+        text = render()
+        FileManager.write_atomic(self.file_path, lambda file: file.write(text))
+
+    def write_forever(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except OSError as e:
+                logger.error(f"Failed to write metrics: {e}")
@@ -3,50 +3,172 @@ import json
 import math
 import re
 import time
+from functools import cached_property
 
+from src.core import metrics
 from src.model.village import VillageData
 
+# Patterns of the fragments that are extracted from a page, by name
+patterns = {
+    "villages": re.compile(
+        r'php\?village=(\d+)&amp;screen=overview"><span class="icon header village"></span>([^<]*)</a>'),
+    "game_data": re.compile(r'TribalWars\.updateGameData\((.+?)\);'),
+    "csrf_token": re.compile('<meta content="(.+?)" name="csrf-token"'),
+    "h": re.compile(r'&h=(\w+)'),
+    "body": re.compile(r'<body[^>]*>'),
+    "build_queue": re.compile(r'(?s)<table id="build_queue"(.+?)</table>'),
+    "build_queue_task": re.compile(r'class="lit-item">\s*<img src=".*/(\w+).png[^>]+>\s*\w+<br />\s+Level (\d+)'
+                                   r'([^=]+=[^=]+=[^=]+="(\d+))*'),
+    "building_data": re.compile(r'(?s)BuildingMain.buildings = (\{.+?});'),
+    "production_row": re.compile(r'(?s)<tr[^>]*>(.*?)</tr>'),
+    "production_village": re.compile(r'village=(\d+)&amp;screen=overview'),
+    "production_cell": re.compile(r'(?s)<td[^>]*>(.*?)</td>'),
+    "production_resource": re.compile(r'class="[^"]*\b(wood|stone|iron)\b[^"]*"[^>]*>\s*([\d.]+)\s*</span>'),
+    "grey_separator": re.compile(r'<span class="grey">\.</span>'),
+    "tag": re.compile(r'<[^>]+>'),
+    "finish_early": re.compile(r'(?s)(\d+),\s*\'BuildInstantFree.+?data-available-from="(\d+)"'),
+}
 
-class PageParser:
-    """Class for parsing the response from the server."""
 
-    @staticmethod
-    def get_villages_from_overview(response):
-        """Get the villages from the overview page."""
-        results = re.findall(
-            r'php\?village=(\d+)&amp;screen=overview"><span class="icon header village"></span>([^<]*)</a>',
-            response.text)
+class ParsedPage:
+    """Lazily parsed view of a page. Every fragment is extracted from the text at most once and then memoized.
+
+    The page is either a full html page, or the json of a screen that was fetched with _partial: the html of the
+    content without the layout of the page, and the game data. Fragments of the html are searched in the markup,
+    which is the content of such json."""
+
+    def __init__(self, text, url=None, partial=False):
+        self.text = text
+        self.url = url
+        self.partial = partial
+
+    @cached_property
+    def markup(self):
+        """The html of the page, the content of a json screen or otherwise the text."""
+        if self.ajax_response is not None and isinstance(self.ajax_response.get("content"), str):
+            return self.ajax_response["content"]
+        return self.text
+
+    @cached_property
+    def villages(self):
+        """The villages from the overview page."""
+        results = patterns["villages"].findall(self.markup)
 
         return list(set([(int(village_id), html.unescape(village_name)) for village_id, village_name in results]))
 
-    @staticmethod
-    def get_village_data_from_village_overview(response):
-        """Get the village data from the overview_village response."""
-        result = re.search(r'TribalWars\.updateGameData\((.+?)\);', response.text)
-        if result:
-            json_data = json.loads(result.group(1), strict=False)
-            return VillageData.from_json(json_data['village'])
+    @cached_property
+    def village_resources(self):
+        """The resources, storage, population and points of all villages from the production overview, by village
+        id. Only the fields of VillageData that the overview shows are included."""
+        villages = {}
+        for row in patterns["production_row"].findall(self.markup):
+            village_id = patterns["production_village"].search(row)
+            if not village_id:
+                continue
 
-        return None
+            row = patterns["grey_separator"].sub("", row)
+            cells = patterns["production_cell"].findall(row)
+            resources = dict(patterns["production_resource"].findall(row))
+            resource_cell = next(
+                (index for index, cell in enumerate(cells) if patterns["production_resource"].search(cell)), None)
+            if resource_cell is None or len(resources) != 3 or len(cells) < resource_cell + 4:
+                continue
 
-    @staticmethod
-    def get_game_state(response):
-        """Get the main page."""
-        result = re.search(r'TribalWars\.updateGameData\((.+?)\);', response.text)
+            points = patterns["tag"].sub("", cells[resource_cell - 1]).strip().replace(".", "")
+            storage = patterns["tag"].sub("", cells[resource_cell + 1]).strip().replace(".", "")
+            farm = patterns["tag"].sub("", cells[resource_cell + 3]).strip().split("/")
+            if not points.isdigit() or not storage.isdigit() or len(farm) != 2:
+                continue
+
+            data = {resource: int(value.replace(".", "")) for resource, value in resources.items()}
+            data.update({f"{resource}_float": float(value) for resource, value in data.items()})
+            data.update({
+                "points": int(points),
+                "storage_max": int(storage),
+                "pop": int(farm[0]),
+                "pop_max": int(farm[1]),
+            })
+            villages[int(village_id.group(1))] = data
+
+        return villages
+
+    @cached_property
+    def game_data(self):
+        """The game data that is passed to TribalWars.updateGameData, or that is part of a json response."""
+        if self.ajax_response is not None:
+            return self.ajax_response.get("game_data")
+
+        result = patterns["game_data"].search(self.text)
         if result:
             return json.loads(result.group(1), strict=False)
 
         return None
 
-    @staticmethod
-    def get_building_queue(response):
-        """Get the building queue from the building page."""
-        result = re.search(r'(?s)<table id="build_queue"(.+?)</table>', response.text)
+    @cached_property
+    def ajax_response(self):
+        """The decoded json of an ajax response, or None if the page isn't json."""
+        if not self.text.startswith("{"):
+            return None
+
+        try:
+            return json.loads(self.text, strict=False)
+        except ValueError:
+            return None
+
+    @cached_property
+    def ajax_error(self):
+        """The error message of an ajax response, or None if there is no error."""
+        if self.ajax_response is None or "error" not in self.ajax_response:
+            return None
+
+        error = self.ajax_response["error"]
+        return ", ".join(error) if isinstance(error, list) else str(error)
+
+    @cached_property
+    def village_data(self):
+        """The village data from the game data."""
+        if self.game_data is None:
+            return None
+
+        return VillageData.from_json(self.game_data['village'])
+
+    @cached_property
+    def csrf_token(self):
+        result = patterns["csrf_token"].search(self.text)
+        if result:
+            return result.group(1)
+
+        # Json responses have no meta tags, the token is part of the game data
+        return self.csrf_from_game_data
+
+    @cached_property
+    def h(self):
+        result = patterns["h"].search(self.markup)
+        if result:
+            return result.group(1)
+
+        return self.csrf_from_game_data
+
+    @cached_property
+    def csrf_from_game_data(self):
+        if self.ajax_response is None or not isinstance(self.game_data, dict):
+            return None
+        return self.game_data.get("csrf")
+
+    @cached_property
+    def captcha(self):
+        """Whether the page shows a captcha."""
+        marker = 'data-bot-protect="forced"'
+        return marker in self.text or (self.markup is not self.text and marker in self.markup)
+
+    @cached_property
+    def building_queue(self):
+        """The building queue from the building page."""
+        result = patterns["build_queue"].search(self.markup)
         if not result:
             return []
 
-        tasks = re.findall(r'class="lit-item">\s*<img src=".*/(\w+).png[^>]+>\s*\w+<br />\s+Level (\d+)([^=]+=[^=]+=['
-                           r'^=]+="(\d+))*', result.group(1))
+        tasks = patterns["build_queue_task"].findall(result.group(1))
         if not tasks:
             return []
 
@@ -63,18 +185,80 @@ class PageParser:
 
         return queue
 
-    @staticmethod
-    def get_building_data(response):
-        result = re.search(r'(?s)BuildingMain.buildings = (\{.+?});', response.text)
+    @cached_property
+    def building_data(self):
+        result = patterns["building_data"].search(self.markup)
         if result:
             return json.loads(result.group(1), strict=False)
 
         return None
 
-    @staticmethod
-    def get_finish_early_id(response):
-        result = re.search(r'(?s)(\d+),\s*\'BuildInstantFree.+?data-available-from="(\d+)"', response.text)
+    @cached_property
+    def finish_early(self):
+        result = patterns["finish_early"].search(self.markup)
         if result:
             return result.group(1), int(result.group(2))
 
         return None
+
+
+class PageParser:
+    """Class for parsing the response from the server."""
+
+    @staticmethod
+    @metrics.parse_seconds.timed(method="parse")
+    def parse(response):
+        """Get the parsed page of the response. The parsed page is stored on the response, so all consumers of the same
+        response share it."""
+        page = getattr(response, "parsed_page", None)
+        if page is None:
+            page = ParsedPage(response.text, response.url)
+            response.parsed_page = page
+
+        return page
+
+    @staticmethod
+    @metrics.parse_seconds.timed(method="get_villages_from_overview")
+    def get_villages_from_overview(response):
+        """Get the villages from the overview page."""
+        return PageParser.parse(response).villages
+
+    @staticmethod
+    @metrics.parse_seconds.timed(method="get_village_resources")
+    def get_village_resources(response):
+        """Get the resources, storage, population and points of all villages from the production overview."""
+        return PageParser.parse(response).village_resources
+
+    @staticmethod
+    @metrics.parse_seconds.timed(method="get_village_data")
+    def get_village_data(response):
+        """Get the village data from the game data of any game page or ajax response."""
+        return PageParser.parse(response).village_data
+
+    @staticmethod
+    @metrics.parse_seconds.timed(method="get_ajax_error")
+    def get_ajax_error(response):
+        """Get the error message of an ajax response, or None if the action succeeded."""
+        return PageParser.parse(response).ajax_error
+
+    @staticmethod
+    @metrics.parse_seconds.timed(method="get_game_state")
+    def get_game_state(response):
+        """Get the main page."""
+        return PageParser.parse(response).game_data
+
+    @staticmethod
+    @metrics.parse_seconds.timed(method="get_building_queue")
+    def get_building_queue(response):
+        """Get the building queue from the building page."""
+        return PageParser.parse(response).building_queue
+
+    @staticmethod
+    @metrics.parse_seconds.timed(method="get_building_data")
+    def get_building_data(response):
+        return PageParser.parse(response).building_data
+
+    @staticmethod
+    @metrics.parse_seconds.timed(method="get_finish_early_id")
+    def get_finish_early_id(response):
+        return PageParser.parse(response).finish_early
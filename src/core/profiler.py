@@ -0,0 +1,102 @@
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+from src.core.file_manager import FileManager
+
+logger = logging.getLogger("Profiler")
+
+
+class Profiler:
+    """Profiles bot cycles or single village runs with cProfile and tracemalloc, and writes the pstats, the slowest
+    functions and the largest allocations of every profiled call to data/profiles. Sleeps are left out, so only the
+    active work (parsing, decoding, writing files and waiting on the network) is measured."""
+    directory = os.path.join("data", "profiles")
+    top = 30
+
+    def __init__(self, target="cycle"):
+        self.target = target
+        self.count = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.real_sleep = time.sleep
+
+    def install(self, bot):
+        """Wrap the cycles of the bot, or the runs of its villages, in the profiler."""
+        FileManager.create_directory(self.directory)
+        time.sleep = self.sleep
+        tracemalloc.start()
+
+        if self.target == "cycle":
+            if bot.config.get("bot.workers", 1) > 1:
+                logger.warning("cProfile only sees the main thread, profile with --profile-target village to see "
+                               "the work of the workers")
+            bot.run_cycle = self.wrap(bot.run_cycle, lambda *args: "cycle")
+            bot.run_due = self.wrap(bot.run_due, lambda *args: "cycle")
+        else:
+            from src.game.village import Village
+            Village.run = self.wrap(Village.run, lambda village: f"village-{village.village_id}")
+
+    def sleep(self, seconds):
+        """Sleep without the sleep showing up in the profile of the current thread."""
+        profile = getattr(self.local, "profile", None)
+        if profile is None:
+            self.real_sleep(seconds)
+            return
+
+        profile.disable()
+        try:
+            self.real_sleep(seconds)
+        finally:
+            profile.enable()
+
+    def wrap(self, function, get_name):
+        """Profile every call of the function, get_name gets the arguments and names the output files."""
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.lock:
+                self.count += 1
+                name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.count:04d}-{get_name(*args)}"
+
+            profile = cProfile.Profile()
+            before = tracemalloc.take_snapshot()
+            try:
+                profile.enable()
+            except ValueError:
+                # Since python 3.12 only one profiler can be active at a time, concurrent calls run unprofiled
+                logger.debug(f"Another call is being profiled, not profiling {name}")
+                return function(*args, **kwargs)
+
+            self.local.profile = profile
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                self.local.profile = None
+                self.save(name, profile, tracemalloc.take_snapshot().compare_to(before, "lineno"))
+
+        return wrapper
+
+    def save(self, name, profile, allocations):
+        """Write the pstats and a text summary with the slowest functions and the largest allocations."""
+        path = os.path.join(FileManager.get_root_path(), self.directory, name)
+        profile.dump_stats(f"{path}.pstats")
+
+        summary = io.StringIO()
+        stats = pstats.Stats(profile, stream=summary)
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(self.top)
+        summary.write(f"Top {self.top} allocations\n")
+        for difference in allocations[:self.top]:
+            summary.write(f"{difference}\n")
+
+        with open(f"{path}.txt", "w") as file:
+            file.write(summary.getvalue())
+
+        logger.info(f"Profiled {name} in {stats.total_tt:.3f} seconds, written to {path}.txt")
@@ -0,0 +1,72 @@
+import logging
+import os
+import signal
+import threading
+import time
+
+from src.core.file_manager import FileManager
+
+logger = logging.getLogger("Quarantine")
+
+
+class SessionQuarantined(Exception):
+    """Raised for requests of a session that is quarantined until a captcha is solved."""
+
+
+class Quarantine:
+    """Quarantine of a session that ran into a captcha. While quarantined the session makes no requests, the work that
+    needs it is parked and everything else keeps running. It is resumed by deleting the marker file or by sending the
+    process SIGUSR1, the bot picks that up with poll. Stdin is left alone, so it doesn't compete with the questions of
+    Input."""
+    marker_file = os.path.join("data", "captcha.json")
+    poll_interval = 1
+
+    def __init__(self):
+        self.resumed = threading.Event()
+        self.resumed.set()
+        self.since = None
+        self.signalled = False
+        self.install_signal_handler()
+
+    @property
+    def active(self):
+        return not self.resumed.is_set()
+
+    def install_signal_handler(self):
+        """Resume on SIGUSR1. Signal handlers can only be installed from the main thread, and not on every platform.
+        The handler only sets a flag, poll picks it up."""
+        if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, self.on_signal)
+
+    def on_signal(self, signum, frame):
+        self.signalled = True
+
+    def enter(self, url):
+        """Quarantine the session because of a captcha on the page with the given url."""
+        if self.active:
+            return
+
+        self.since = time.time()
+        self.signalled = False
+        FileManager.save_json_file(self.marker_file, {"url": url, "since": self.since})
+        self.resumed.clear()
+        logger.warning(f"Captcha detected on {url}, the session is quarantined. Solve the captcha in the browser, then "
+                       f"delete {self.marker_file} or send SIGUSR1 to process {os.getpid()}")
+
+    def resume(self, reason):
+        if not self.active:
+            return
+
+        FileManager.remove_file(self.marker_file)
+        self.resumed.set()
+        logger.info(f"Session resumed ({reason}) after {round(time.time() - self.since)} seconds")
+
+    def poll(self):
+        """Resume the session if the signal was received or the marker file was removed. Returns whether the session
+        is still quarantined, without blocking."""
+        if self.active:
+            if self.signalled:
+                self.resume("signal")
+            elif not FileManager.path_exists(self.marker_file):
+                self.resume("marker file removed")
+        return self.active
@@ -0,0 +1,43 @@
+import threading
+import time
+
+from src.core import metrics
+
+
+class RateLimiter:
+    """Token bucket shared by every worker of an account to enforce the requests-per-second cap."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        """Allow `rate` requests per second on average with bursts of up to `burst` requests."""
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def set_rate(self, rate: float):
+        """Change the average rate, the tokens that were earned at the old rate are kept."""
+        with self.lock:
+            self._refill()
+            self.rate = rate
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+
+            metrics.sleep_seconds.inc(wait, reason="rate_limit")
+            time.sleep(wait)
@@ -0,0 +1,149 @@
+import logging
+import random
+import threading
+import time
+
+from src.core import metrics
+from src.core.config import Config
+from src.core.rate_limiter import RateLimiter
+
+logger = logging.getLogger("RequestController")
+
+# Statuses with which the server says it is overloaded or temporarily down
+retry_statuses = frozenset((429, 500, 502, 503, 504))
+
+
+class RequestFailed(Exception):
+    """Raised when a request failed and retrying didn't help, or when the circuit of its endpoint is open."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class CircuitBreaker:
+    """Stops requests to an endpoint that keeps failing. After `failure_threshold` failures in a row the circuit opens
+    and requests fail at once for `reset_timeout` seconds. Then a single trial request is let through, which closes the
+    circuit again if it succeeds."""
+
+    def __init__(self, endpoint, failure_threshold=5, reset_timeout=60):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """Check whether a request may be made, and mark it as the trial request if the circuit is half open."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.trial = True
+            return True
+
+    def cancel_trial(self):
+        """Let the next request be the trial request, when the trial ended without a response or a failure."""
+        with self.lock:
+            self.trial = False
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuit of {self.endpoint} closed")
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+                if self.opened_at is None:
+                    logger.warning(f"Circuit of {self.endpoint} opened after {self.failures} failures, requests fail "
+                                   f"for {self.reset_timeout} seconds")
+                    metrics.circuit_opened_total.inc(endpoint=self.endpoint)
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+
+class RequestController:
+    """Decides how requests are paced and retried for an account.
+
+    Failed requests are retried a bounded number of times with exponential backoff and full jitter, honouring the
+    Retry-After header. Every endpoint has its own circuit breaker. The delay after a screen request adapts between
+    bot.delays.request.min and max: it shrinks a little after every fast response and doubles after a 429, a server
+    error or a slow response. The rate of the rate limiter follows the same way, below its configured rate, so the
+    bot settles just under what the server tolerates."""
+    # Every fast response takes this fraction of the delay off
+    speedup = 0.05
+    # The rate of the rate limiter never drops below this fraction of the configured rate
+    min_rate_factor = 0.1
+
+    def __init__(self, config: Config, rate_limiter: RateLimiter):
+        self.config = config
+        self.rate_limiter = rate_limiter
+        self.max_rate = rate_limiter.rate
+
+        self.max_retries = config.get("bot.retry.max_retries", 3)
+        self.backoff_base = config.get("bot.retry.backoff_base", 1)
+        self.backoff_max = config.get("bot.retry.backoff_max", 60)
+        self.failure_threshold = config.get("bot.retry.circuit_failures", 5)
+        self.reset_timeout = config.get("bot.retry.circuit_reset", 60)
+
+        self.min_delay = config.get("bot.delays.request.min", 0.5)
+        self.max_delay = max(self.min_delay, config.get("bot.delays.request.max", 1))
+        self.adaptive = config.get("bot.delays.request.adaptive", True)
+        self.slow_response = config.get("bot.delays.request.slow_response", 2)
+        self.delay = (self.min_delay + self.max_delay) / 2
+
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get_breaker(self, endpoint):
+        with self.lock:
+            breaker = self.breakers.get(endpoint)
+            if breaker is None:
+                breaker = CircuitBreaker(endpoint, self.failure_threshold, self.reset_timeout)
+                self.breakers[endpoint] = breaker
+            return breaker
+
+    def get_backoff(self, attempt, retry_after=None):
+        """Get the seconds to wait before the given retry (counting from 1)."""
+        backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+        try:
+            backoff = max(backoff, min(self.backoff_max, float(retry_after)))
+        except (TypeError, ValueError):
+            pass
+        return backoff
+
+    def get_delay(self):
+        """Get the delay after a screen request, with jitter."""
+        if not self.adaptive:
+            return random.uniform(self.min_delay, self.max_delay)
+        delay = self.delay
+        return min(self.max_delay, max(self.min_delay, random.uniform(delay * 0.75, delay * 1.25)))
+
+    def on_response(self, seconds, status_code=200):
+        """Adapt the delay and rate to a response that took the given number of seconds. A status_code of None means
+        the request didn't get a response."""
+        if not self.adaptive:
+            return
+
+        throttled = status_code is None or status_code in retry_statuses or seconds >= self.slow_response
+        with self.lock:
+            if throttled:
+                self.delay = min(self.max_delay, self.delay * 2)
+                rate = max(self.max_rate * self.min_rate_factor, self.rate_limiter.rate / 2)
+            else:
+                self.delay = max(self.min_delay, self.delay * (1 - self.speedup))
+                rate = min(self.max_rate, self.rate_limiter.rate + self.max_rate * self.speedup)
+        if rate != self.rate_limiter.rate:
+            self.rate_limiter.set_rate(rate)
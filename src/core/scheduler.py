@@ -0,0 +1,47 @@
+import heapq
+import itertools
+import math
+import time
+
+from src.core.time_utils import TimeUtils
+
+
+class Scheduler:
+    """Priority queue of items ordered by the unix timestamp at which they should run next."""
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, item, run_at: float):
+        """Schedule an item to run at the given unix timestamp."""
+        heapq.heappush(self.heap, (run_at, next(self.counter), item))
+
+    def next_run_at(self):
+        """Get the unix timestamp of the earliest deadline, or None if nothing is scheduled."""
+        if not self.heap:
+            return None
+        return self.heap[0][0]
+
+    def pop_due(self, now=None):
+        """Remove and return all items of which the deadline has passed."""
+        now = time.time() if now is None else now
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[2])
+        return due
+
+    def sleep_until_next(self, limit=None):
+        """Sleep until the earliest deadline, or until the limit (a unix timestamp) if that comes first."""
+        next_run_at = self.next_run_at()
+        if limit is not None:
+            next_run_at = limit if next_run_at is None else min(next_run_at, limit)
+        if next_run_at is None:
+            return
+
+        seconds = math.ceil(next_run_at - time.time())
+        if seconds > 0:
+            TimeUtils.sleep(seconds)
@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from src.core.file_manager import FileManager
+
+logger = logging.getLogger("StateStore")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS village_snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    village_id INTEGER NOT NULL,
+    taken_at REAL NOT NULL,
+    wood INTEGER NOT NULL,
+    stone INTEGER NOT NULL,
+    iron INTEGER NOT NULL,
+    pop INTEGER NOT NULL,
+    pop_max INTEGER NOT NULL,
+    storage_max INTEGER NOT NULL,
+    points INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS village_snapshots_village ON village_snapshots (village_id, taken_at);
+
+CREATE TABLE IF NOT EXISTS build_queue (
+    village_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    building TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    finish_at INTEGER NOT NULL,
+    PRIMARY KEY (village_id, position)
+);
+CREATE INDEX IF NOT EXISTS build_queue_finish ON build_queue (finish_at);
+
+CREATE TABLE IF NOT EXISTS building_state (
+    village_id INTEGER PRIMARY KEY,
+    fetched_at REAL NOT NULL,
+    building_data TEXT,
+    waiting_for TEXT,
+    wake_times TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    village_id INTEGER NOT NULL,
+    executed_at REAL NOT NULL,
+    action TEXT NOT NULL,
+    building TEXT,
+    level INTEGER,
+    success INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS actions_village ON actions (village_id, executed_at);
+CREATE INDEX IF NOT EXISTS actions_executed ON actions (executed_at);
+"""
+
+
+def format_hour(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+
+class StateStore:
+    """SQLite store (in WAL mode) for village snapshots, build queues and executed actions. Writes are buffered in
+    memory and written in one transaction per cycle by flush, reads go straight to the database.
+
+    Snapshots and actions older than the retention are deleted, except the last snapshot of every village."""
+    # Old rows are deleted at most this often, in seconds
+    prune_interval = 3600
+
+    def __init__(self, path, retention=None):
+        self.retention = retention
+        self.pruned_at = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.pending = []
+
+    @staticmethod
+    def open(config):
+        """Open the store configured with bot.state_store, or return None if it's disabled."""
+        if not config.get("bot.state_store.enabled", False):
+            return None
+
+        file_path = config.get("bot.state_store.path", "data/state.db")
+        full_path = os.path.join(FileManager.get_root_path(), file_path)
+        logger.debug(f"Opening state store {full_path}")
+        return StateStore(full_path, config.get("bot.state_store.retention_days", 7) * 86400)
+
+    def queue_write(self, sql, *parameters):
+        with self.lock:
+            self.pending.append((sql, parameters))
+
+    def record_snapshot(self, village_data):
+        """Buffer a snapshot of the village data. It is stored with the time the game took it."""
+        self.queue_write(
+            "INSERT INTO village_snapshots (village_id, taken_at, wood, stone, iron, pop, pop_max, storage_max, "
+            "points, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            village_data.id, village_data.last_res_tick / 1000, village_data.wood, village_data.stone,
+            village_data.iron, village_data.pop, village_data.pop_max, village_data.storage_max, village_data.points,
+            json.dumps(village_data.to_json()))
+
+    def save_building_state(self, village_id, building_queue, building_data, fetched_at, waiting_for, wake_times):
+        """Buffer the build queue and the scheduling state of the building manager of a village."""
+        self.queue_write("DELETE FROM build_queue WHERE village_id = ?", village_id)
+        for position, (building, level, finish_at) in enumerate(building_queue):
+            self.queue_write("INSERT INTO build_queue (village_id, position, building, level, finish_at) "
+                             "VALUES (?, ?, ?, ?, ?)", village_id, position, building, level, finish_at)
+
+        self.queue_write(
+            "INSERT OR REPLACE INTO building_state (village_id, fetched_at, building_data, waiting_for, wake_times) "
+            "VALUES (?, ?, ?, ?, ?)",
+            village_id, fetched_at, json.dumps(building_data), waiting_for, json.dumps(wake_times))
+
+    def record_action(self, village_id, action, building=None, level=None, success=True):
+        """Buffer an action that was executed for a village."""
+        self.queue_write("INSERT INTO actions (village_id, executed_at, action, building, level, success) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", village_id, time.time(), action, building, level, int(success))
+
+    def flush(self):
+        """Write all buffered changes in a single transaction, and delete old rows once per prune_interval."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if pending:
+                with self.connection:
+                    for sql, parameters in pending:
+                        self.connection.execute(sql, parameters)
+                logger.debug(f"Flushed {len(pending)} changes")
+
+            if self.retention and time.time() - self.pruned_at >= self.prune_interval:
+                self.prune(time.time() - self.retention)
+
+    def prune(self, before):
+        """Delete the snapshots and actions from before the given unix timestamp. The last snapshot of a village is
+        kept, it is what a restart continues from."""
+        self.pruned_at = time.time()
+        with self.connection:
+            snapshots = self.connection.execute(
+                "DELETE FROM village_snapshots WHERE taken_at < ? AND taken_at < (SELECT MAX(taken_at) FROM "
+                "village_snapshots AS latest WHERE latest.village_id = village_snapshots.village_id)",
+                (before,)).rowcount
+            actions = self.connection.execute("DELETE FROM actions WHERE executed_at < ?", (before,)).rowcount
+        if snapshots or actions:
+            logger.debug(f"Deleted {snapshots} snapshots and {actions} actions older than the retention")
+
+    def load_village(self, village_id):
+        """Get the last snapshot (as game data json), the build queue and the building state of a village. Any of
+        these is None if it isn't stored."""
+        with self.lock:
+            snapshot = self.connection.execute(
+                "SELECT data FROM village_snapshots WHERE village_id = ? ORDER BY taken_at DESC LIMIT 1",
+                (village_id,)).fetchone()
+            queue = self.connection.execute(
+                "SELECT building, level, finish_at FROM build_queue WHERE village_id = ? ORDER BY position",
+                (village_id,)).fetchall()
+            state = self.connection.execute(
+                "SELECT fetched_at, building_data, waiting_for, wake_times FROM building_state WHERE village_id = ?",
+                (village_id,)).fetchone()
+
+        if state is not None:
+            fetched_at, building_data, waiting_for, wake_times = state
+            state = {
+                "fetched_at": fetched_at,
+                "building_data": json.loads(building_data),
+                "waiting_for": waiting_for,
+                "wake_times": json.loads(wake_times),
+            }
+
+        return json.loads(snapshot[0]) if snapshot else None, [tuple(task) for task in queue], state
+
+    def production_history(self, village_id, since):
+        """Get (taken_at, wood, stone, iron) of the snapshots of a village since the given unix timestamp."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT taken_at, wood, stone, iron FROM village_snapshots WHERE village_id = ? AND taken_at >= ? "
+                "ORDER BY taken_at", (village_id, since)).fetchall()
+
+    def actions_per_hour(self, since):
+        """Get the number of successful actions per hour since the given unix timestamp as (hour, count)."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT CAST(executed_at / 3600 AS INTEGER) * 3600 AS hour, COUNT(*) FROM actions "
+                "WHERE executed_at >= ? AND success = 1 GROUP BY hour ORDER BY hour", (since,)).fetchall()
+
+    def report(self, villages, since):
+        """Get the lines of a report of the successful actions per hour and the resources of the villages since the
+        given unix timestamp. villages are (id, name) tuples, the resources are those of the last snapshot of every
+        hour."""
+        lines = ["Actions per hour"]
+        for hour, count in self.actions_per_hour(since):
+            lines.append(f"  {format_hour(hour)} {count:>8}")
+
+        for village_id, village_name in villages:
+            lines.append(f"Resources of {village_name} ({village_id})")
+            hours = {}
+            for taken_at, wood, stone, iron in self.production_history(village_id, since):
+                hours[int(taken_at // 3600) * 3600] = (wood, stone, iron)
+            for hour, (wood, stone, iron) in hours.items():
+                lines.append(f"  {format_hour(hour)} {wood:>8} {stone:>8} {iron:>8}")
+        return lines
+
+    def close(self):
+        self.flush()
+        self.connection.close()
@@ -1,11 +1,20 @@
 import sys
 import time
 
+from src.core import metrics
+
 
 class TimeUtils:
+    show_countdown = True
+
     @staticmethod
     def sleep(seconds: int):
-        """Sleep for a given amount of seconds. This method will print a countdown to the console."""
+        """Sleep for a given amount of seconds. This method will print a countdown to the console, unless the
+        countdown is turned off (like in supervised workers that share the console)."""
+        metrics.sleep_seconds.inc(seconds, reason="idle")
+        if not TimeUtils.show_countdown:
+            time.sleep(seconds)
+            return
 
         # Hacky? Yes. Does it work? Also yes.
         # Wait for the logger to finish writing
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import threading
+from abc import ABC, abstractmethod
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.core.config import Config
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def accept_encoding():
+    """Get the encodings to negotiate, brotli is only offered when a brotli decoder is installed."""
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        try:
+            import brotlicffi  # noqa: F401
+        except ImportError:
+            return "gzip, deflate"
+    return "gzip, deflate, br"
+
+
+class Transport(ABC):
+    """Sends the HTTP requests of the WebWrapper. The WebWrapper takes care of the game specific handling (cookies,
+    CSRF-Token, last_h), a transport only moves bytes."""
+    # Exceptions with which a request fails without a response, these are retried
+    errors = (OSError,)
+
+    @staticmethod
+    def create(config: Config):
+        """Create the transport that is configured with web.transport."""
+        name = config.get("web.transport", "requests")
+        if name == "requests":
+            return RequestsTransport(config)
+        if name == "async":
+            return AsyncTransport(config)
+        raise ValueError(f"Unknown transport {name}")
+
+    @abstractmethod
+    def request(self, method, url, headers=None, data=None, stream=False):
+        """Make a request and return a response with status_code, url, text, iter_content and close."""
+
+    @abstractmethod
+    def update_cookies(self, cookies):
+        """Add cookies (a dict of name to value) to the session."""
+
+    def close(self):
+        """Close all connections."""
+
+
+class RequestsTransport(Transport):
+    """Blocking transport on requests sessions with a keep-alive connection pool. A requests session isn't thread safe,
+    so every thread gets its own session. They share the connection pool and the cookie jar, which are."""
+
+    def __init__(self, config: Config):
+        self.timeout = config.get("web.timeout", 30)
+        pool_size = config.get("web.pool_size", 10)
+
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.local = threading.local()
+
+    @property
+    def session(self):
+        """The session of the current thread."""
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.session()
+            session.mount("https://", self.adapter)
+            session.mount("http://", self.adapter)
+            session.cookies = self.cookies
+            session.headers.update({
+                "Accept-Encoding": accept_encoding(),
+            })
+            self.local.session = session
+        return session
+
+    def request(self, method, url, headers=None, data=None, stream=False):
+        return self.session.request(method, url, headers=headers, data=data, stream=stream, timeout=self.timeout)
+
+    def update_cookies(self, cookies):
+        self.cookies.update(cookies)
+
+    def close(self):
+        self.adapter.close()
+
+
+class AsyncResponse:
+    """Response of the AsyncTransport with the parts of the requests.Response interface that the bot uses."""
+
+    def __init__(self, transport, response, content=None):
+        self.transport = transport
+        self.response = response
+        self.status_code = response.status
+        self.url = str(response.url)
+        self.headers = response.headers
+        self.encoding = response.charset
+        self._content = content
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self.iter_content(65536))
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or "utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1):
+        """Read the body chunk by chunk from the event loop."""
+        if self._content is not None:
+            yield from (self._content[i:i + chunk_size] for i in range(0, len(self._content), chunk_size))
+            return
+
+        while True:
+            chunk = self.transport.run(self.response.content.read(chunk_size))
+            if not chunk:
+                break
+            yield chunk
+
+    def close(self):
+        # aiohttp objects may only be used from the thread of their event loop
+        self.transport.loop.call_soon_threadsafe(self.response.close)
+
+
+class AsyncTransport(Transport):
+    """Transport on an aiohttp session that runs in its own event loop thread. Every village worker hands its requests
+    to this loop and waits for its own response, so the requests of concurrent workers share one event loop and one
+    keep-alive pool instead of a thread per connection. A single worker still makes one request at a time."""
+    errors = (OSError, asyncio.TimeoutError, aiohttp.ClientError) if aiohttp is not None else (OSError,)
+
+    def __init__(self, config: Config):
+        if aiohttp is None:
+            raise ImportError("The async transport needs aiohttp, install it with `python -m pip install aiohttp`")
+
+        self.timeout = aiohttp.ClientTimeout(total=config.get("web.timeout", 30))
+        self.pool_size = config.get("web.pool_size", 10)
+        self.keepalive_timeout = config.get("web.keepalive_timeout", 30)
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="Transport", daemon=True)
+        self.thread.start()
+        self.session = self.run(self.create_session())
+
+    async def create_session(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=self.timeout,
+                                     cookie_jar=aiohttp.CookieJar(unsafe=True),
+                                     headers={"Accept-Encoding": accept_encoding()})
+
+    def run(self, coroutine):
+        """Run a coroutine on the event loop and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def request_async(self, method, url, headers=None, data=None, stream=False):
+        """Make a request from within the event loop. Unless streaming, the body is read before returning."""
+        response = await self.session.request(method, url, headers=headers, data=data)
+        if stream:
+            return AsyncResponse(self, response)
+
+        content = await response.read()
+        response.release()
+        return AsyncResponse(self, response, content)
+
+    def request(self, method, url, headers=None, data=None, stream=False):
+        return self.run(self.request_async(method, url, headers=headers, data=data, stream=stream))
+
+    def update_cookies(self, cookies):
+        async def update():
+            self.session.cookie_jar.update_cookies(cookies)
+
+        self.run(update())
+
+    def close(self):
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -1,41 +1,93 @@
+import codecs
 import json
 import logging
-import random
 import re
+import threading
 import time
 
-import requests
-
+from src.core import metrics
+from src.core.bootstrap import bootstrap
 from src.core.config import Config
 from src.core.file_manager import FileManager
 from src.core.input import Input
+from src.core.page_parser import PageParser, ParsedPage, patterns
+from src.core.quarantine import Quarantine, SessionQuarantined
+from src.core.rate_limiter import RateLimiter
+from src.core.request_controller import RequestController, RequestFailed, retry_statuses
+from src.core.transport import Transport
 
 logger = logging.getLogger("WebWrapper")
 
+endpoint_patterns = (re.compile(r"[?&]ajaxaction=(\w+)"), re.compile(r"[?&]screen=(\w+)"))
+
+
+class SessionExpired(Exception):
+    """Raised when the session expired and there is no user to ask for new cookies."""
+
+
+def get_endpoint(url):
+    """Get the ajax action or screen that an url requests, to label the metrics with."""
+    for pattern in endpoint_patterns:
+        match = pattern.search(url)
+        if match:
+            return match.group(1)
+    return "other"
+
 
 class WebWrapper:
-    """Wrapper for the requests library to handle the web requests and cookies."""
+    """Wrapper around the transport to handle the web requests and cookies."""
     last_h = None
-    base_headers = {
-        "Upgrade-Insecure-Requests": "1",
+    request_count = 0
+    session_valid_at = 0
+    # The time the session was valid is saved at most this often
+    session_save_interval = 60
+    # Characters of the text before a new chunk that are searched again with it, for fragments split over chunks
+    stream_overlap = 32768
+    ajax_headers = {
+        'Accept': 'application/json, text/javascript, */*; q=0.01',
+        'X-Requested-With': 'XMLHttpRequest',
+        'tribalwars-ajax': '1',
     }
 
     def __init__(self, config: Config):
-        """Initialize the WebWrapper with the config and a requests session."""
+        """Initialize the WebWrapper with the config and the configured transport."""
         self.config = config
-        self.web = requests.session()
-        self.base_url = f"https://{self.config.get('web.server')}.{self.config.get('web.domain')}"
-
-        self.base_headers.update({
+        self.transport = Transport.create(self.config)
+        self.base_url = self.config.get("web.base_url",
+                                        f"https://{self.config.get('web.server')}.{self.config.get('web.domain')}")
+        self.quarantine = Quarantine()
+        self.json_first = self.config.get("web.json_first", True)
+        # Screens (with their mode) of which the json doesn't have what the bot needs, these are fetched as full pages
+        self.html_screens = set()
+        self.rate_limiter = RateLimiter(self.config.get("bot.rate_limit.requests_per_second", 2),
+                                        self.config.get("bot.rate_limit.burst", 1))
+        self.controller = RequestController(self.config, self.rate_limiter)
+
+        # The headers and last_h are updated after every request, by all village workers
+        self.lock = threading.Lock()
+        self.base_headers = {
+            "Upgrade-Insecure-Requests": "1",
             "User-Agent": self.config.get("web.user-agent"),
-        })
+        }
 
         self.load_cookies()
 
+    def close(self):
+        """Close the connections of the transport."""
+        self.transport.close()
+
     def is_cookie_valid(self):
-        """Check if the current session cache is valid. If not, refresh the cookies."""
-        response = self.get_screen("overview")
+        """Check if the current session cache is valid. If not, refresh the cookies.
+
+        Only the url that the overview ends up at and the tokens of the page are needed, so the full page is fetched
+        and, with web.streaming.enabled, only read up to the body tag."""
+        try:
+            response = self.get_url("game.php?screen=overview", fragments=())
+        except SessionQuarantined:
+            # Captchas are only shown to sessions that are logged in
+            return True
         if "game.php" in response.url:
+            self.mark_session_valid()
             return True
 
         logger.error("Current session cache not valid")
@@ -43,7 +95,10 @@ class WebWrapper:
         return False
 
     def load_cookies(self):
-        """Load the cookies from the cookies.json file. If the cookies are not valid, refresh them."""
+        """Load the cookies from the cookies.json file. If the cookies are not valid, refresh them.
+
+        If the session was valid a short while ago, the cookies are not checked now. The first request checks them
+        anyway, an expired session is refreshed there."""
         cookies_data = FileManager.load_json_file("data/cookies.json")
 
         if cookies_data:
@@ -51,7 +106,11 @@ class WebWrapper:
         else:
             cookies = self.ask_for_cookies()
 
-        self.web.cookies.update(cookies)
+        self.transport.update_cookies(cookies)
+        if cookies_data and self.is_session_fresh():
+            logger.info("Session was valid recently, it is checked by the first request")
+            return
+
         if not self.is_cookie_valid():
             self.refresh_cookies()
 
@@ -60,16 +119,34 @@ class WebWrapper:
     def refresh_cookies(self):
         """Refresh the cookies by asking for the new cookie string and saving it to the cookies.json file."""
         cookies = self.ask_for_cookies()
-        self.web.cookies.update(cookies)
+        self.transport.update_cookies(cookies)
 
         if not self.is_cookie_valid():
             self.refresh_cookies()
 
         FileManager.save_json_file("data/cookies.json", json.dumps(cookies))
 
+    def is_session_fresh(self):
+        """Check if the session of this world was valid within bot.warm_start.max_age seconds."""
+        if not self.config.get("bot.warm_start.enabled", True):
+            return False
+        max_age = self.config.get("bot.warm_start.max_age", 3600)
+        return bootstrap.get_fresh("session", max_age, base_url=self.base_url) is not None
+
+    def mark_session_valid(self):
+        """Remember that the session is valid, for warm starts."""
+        now = time.time()
+        if now - self.session_valid_at >= self.session_save_interval:
+            self.session_valid_at = now
+            bootstrap.set_fresh("session", base_url=self.base_url)
+
     @staticmethod
     def ask_for_cookies():
-        """Ask for the cookie string and parse it into a dictionary."""
+        """Ask for the cookie string and parse it into a dictionary. Raises SessionExpired if there is no user to
+        ask."""
+        if not Input.interactive:
+            raise SessionExpired("The session expired or there are no cookies, and there is no user to ask for them")
+
         cookie_str = Input.ask_string("Enter cookie string", example="cookie1=value1; cookie2=value2")
         cookies = {}
 
@@ -82,7 +159,8 @@ class WebWrapper:
 
     def get_base_headers(self):
         """Get the base headers for the requests."""
-        headers = self.base_headers.copy()
+        with self.lock:
+            headers = self.base_headers.copy()
         headers.update({
             "Origin": f"{self.base_url}/game.php",
         })
@@ -91,51 +169,163 @@ class WebWrapper:
 
     def update_after_request(self, response):
         """Post process the response to update the CSRF-Token, headers and last_h."""
-        csrf_token = re.search('<meta content="(.+?)" name="csrf-token"', response.text)
-        if csrf_token:
-            logger.debug(f"Updating CSRF-Token")
+        page = PageParser.parse(response)
+        csrf_token, h = page.csrf_token, page.h
+        with self.lock:
+            if csrf_token:
+                logger.debug(f"Updating CSRF-Token")
+                self.base_headers.update({
+                    "X-CSRF-Token": csrf_token,
+                })
+            else:
+                self.base_headers.pop("X-CSRF-Token", None)
+
             self.base_headers.update({
-                "X-CSRF-Token": csrf_token.group(1),
+                "Referer": response.url,
             })
-        elif "X-CSRF-Token" in self.base_headers:
-            del self.base_headers["X-CSRF-Token"]
 
-        self.base_headers.update({
-            "Referer": response.url,
-        })
+            if h:
+                logger.debug(f"Updating last_h to {h}")
+                self.last_h = h
 
-        new_h = re.search(r'&h=(\w+)', response.text)
-        if new_h:
-            logger.debug(f"Updating last_h to {new_h.group(1)}")
-            self.last_h = new_h.group(1)
+    def check_captcha(self, response):
+        """Check if the response contains a captcha. If so, quarantine the session until the captcha is solved and
+        raise SessionQuarantined, so the caller parks its work instead of acting on the captcha page."""
+        if PageParser.parse(response).captcha:
+            metrics.captchas_total.inc()
+            self.quarantine.enter(response.url)
+            raise SessionQuarantined(f"Captcha on {response.url}")
 
-    @staticmethod
-    def check_captcha(response):
-        """Check if the response contains a captcha. If so, wait for the user to solve it."""
-        if 'data-bot-protect="forced"' in response.text:
-            logger.warning("Captcha detected, press any key when captcha is solved")
-            Input.wait_for_input()
-            return True
-        return False
+    def request(self, method, url, fragments=None, **kwargs):
+        """Make a request with the given method, url and kwargs. If fragments are given and streaming is enabled, only
+        the start of the body up to the given page fragments is kept.
 
-    def request(self, method, url, **kwargs):
-        """Make a request with the given method, url and kwargs."""
+        Requests that get no response or an overloaded server are retried with backoff, POST requests only on a 429
+        as the server may have handled them otherwise. Raises RequestFailed if the request doesn't succeed."""
         logger.debug(f"Requesting {method} {url} with {kwargs}")
-
-        response = self.web.request(method, url, **kwargs)
-
-        if response.status_code != 200:
-            logger.error(f"Request failed with status code {response.status_code}")
-            return None
+        if self.quarantine.active:
+            raise SessionQuarantined("The session is quarantined until the captcha is solved")
+
+        stream = fragments is not None and self.config.get("web.streaming.enabled", False)
+        endpoint = get_endpoint(url)
+        breaker = self.controller.get_breaker(endpoint)
+
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise RequestFailed(f"Circuit of {endpoint} is open")
+
+            try:
+                self.rate_limiter.acquire()
+                with self.lock:
+                    self.request_count += 1
+                metrics.requests_total.inc(endpoint=endpoint)
+                start = time.perf_counter()
+                retry_after = None
+                try:
+                    response = self.transport.request(method, url, stream=stream, **kwargs)
+                    status_code = response.status_code
+                    error = f"status code {status_code}"
+                except self.transport.errors as e:
+                    status_code = None
+                    error = repr(e)
+            except BaseException:
+                # Neither a success nor a failure of the server, without this a trial request would keep the circuit
+                # open for good
+                breaker.cancel_trial()
+                raise
+
+            self.controller.on_response(time.perf_counter() - start, status_code)
+            if status_code == 200:
+                breaker.record_success()
+                break
+
+            if status_code is not None:
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+            if status_code is None or status_code in retry_statuses:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+            retry = status_code == 429 or (method == "GET" and (status_code is None or status_code in retry_statuses))
+            if not retry or attempt >= self.controller.max_retries or breaker.is_open:
+                logger.error(f"Request to {endpoint} failed: {error}")
+                raise RequestFailed(f"Request to {endpoint} failed: {error}", status_code)
+
+            attempt += 1
+            backoff = self.controller.get_backoff(attempt, retry_after)
+            logger.warning(f"Request to {endpoint} failed: {error}, retry {attempt}/{self.controller.max_retries} in "
+                           f"{backoff:.1f} seconds")
+            metrics.retries_total.inc(endpoint=endpoint)
+            metrics.sleep_seconds.inc(backoff, reason="backoff")
+            time.sleep(backoff)
 
         if "session_expired=1" in response.url:
             logger.error("Session expired, please refresh cookies")
+            metrics.session_expired_total.inc()
+            response.close()
             self.refresh_cookies()
-            self.request(method, url, **kwargs)
+            return self.request(method, url, fragments, **kwargs)
+
+        if "game.php" in response.url:
+            self.mark_session_valid()
+
+        if stream:
+            received = self.read_stream(response, fragments)
+        else:
+            received = len(response.content)
+        metrics.request_seconds.observe(time.perf_counter() - start, endpoint=endpoint)
+        metrics.received_bytes.inc(received, endpoint=endpoint)
 
         return response
 
-    def get_url(self, url, headers=None):
+    def read_stream(self, response, fragments):
+        """Decode a streamed response chunk by chunk until the CSRF-Token, h, the body tag (which carries the captcha
+        marker) and the given fragments are found. The rest of the body is drained without being kept, or the
+        connection is closed if web.streaming.close_early is set. Returns the number of bytes that were received.
+
+        Every chunk is searched together with the end of the text before it, so each character is searched a bounded
+        number of times. A match only counts when a character follows it, a token at the end of a chunk may go on in
+        the next one. Fragments longer than stream_overlap are only found by reading the whole page."""
+        chunk_size = self.config.get("web.streaming.chunk_size", 16384)
+        decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+        missing = {name: patterns[name] for name in ("csrf_token", "h", "body", *fragments)}
+
+        chunks = []
+        page = None
+        tail = ""
+        received = 0
+        iterator = response.iter_content(chunk_size)
+        for chunk in iterator:
+            received += len(chunk)
+            text = decoder.decode(chunk)
+            chunks.append(text)
+            window = tail + text
+            for name, pattern in list(missing.items()):
+                match = pattern.search(window)
+                if match and match.end() < len(window):
+                    del missing[name]
+            if not missing:
+                page = ParsedPage("".join(chunks), response.url, partial=True)
+                break
+            tail = window[-self.stream_overlap:]
+        else:
+            chunks.append(decoder.decode(b"", final=True))
+            page = ParsedPage("".join(chunks), response.url)
+
+        if page.partial:
+            logger.debug(f"Found all fragments after {len(page.text)} characters")
+            if self.config.get("web.streaming.close_early", False):
+                response.close()
+            else:
+                for chunk in iterator:
+                    received += len(chunk)
+
+        response.parsed_page = page
+        return received
+
+    def get_url(self, url, headers=None, fragments=None):
         """Make a GET request to the given url with the given headers."""
         full_url = f"{self.base_url}/{url}"
         base_headers = self.get_base_headers()
@@ -143,46 +333,65 @@ class WebWrapper:
         if headers:
             base_headers.update(headers)
 
-        response = self.request("GET", full_url, headers=base_headers)
+        response = self.request("GET", full_url, fragments, headers=base_headers)
         self.update_after_request(response)
-
-        was_captcha = self.check_captcha(response)
-        if was_captcha:
-            return self.get_url(url, headers)
+        self.check_captcha(response)
 
         return response
 
-    def get_screen(self, screen, params=None):
-        """Make a GET request to the game.php with the given screen and params."""
+    def get_screen(self, screen, params=None, required=()):
+        """Make a GET request to the game.php with the given screen and params.
+
+        If web.json_first is set, the screen is fetched as json first, see get_screen_json. required are the names of
+        the ParsedPage properties that the json has to have, the full page is fetched if one is missing or empty."""
         url = f"game.php?screen={screen}"
         if params:
             url += "&" + "&".join([f"{key}={value}" for key, value in params.items()])
+        # The modes of a screen show different things
+        if params and "mode" in params:
+            screen = f"{screen}&mode={params['mode']}"
 
-        response = self.get_url(url)
+        response = None
+        if self.json_first and screen not in self.html_screens:
+            response = self.get_screen_json(screen, url, required)
+        if response is None:
+            response = self.get_url(url)
 
-        sleep_min = self.config.get("bot.delays.request.min")
-        sleep_max = self.config.get("bot.delays.request.max")
-        sleep = random.uniform(sleep_min, sleep_max)
+        sleep = self.controller.get_delay()
         logger.debug(f"Sleeping for {sleep} seconds")
+        metrics.sleep_seconds.inc(sleep, reason="request_delay")
         time.sleep(sleep)
 
         return response
 
+    def get_screen_json(self, screen, url, required):
+        """Fetch a screen the way the game loads screens in the background: with _partial the server only sends the
+        html of the content and the game data as json, without the layout of the page. Returns None if the game data or
+        a required fragment is missing or empty in the json, the screen is then fetched as a full page from now on."""
+        response = self.get_url(f"{url}&_partial", headers=self.ajax_headers)
+        page = PageParser.parse(response)
+        if page.ajax_response is None:
+            # The server sent the full page instead, or the login page if the session expired
+            if "game.php" in response.url:
+                self.html_screens.add(screen)
+            return response
+
+        missing = [name for name in ("game_data", *required) if not getattr(page, name)]
+        if missing:
+            logger.info(f"The json of screen {screen} has no {', '.join(missing)}, using the full page from now on")
+            self.html_screens.add(screen)
+            return None
+
+        return response
+
     def ajax_post_action(self, village_id, action, data):
         url = f"game.php?village={village_id}&ajaxaction={action}&type=main&screen=main"
-        headers = self.get_base_headers().copy()
-        headers.update({
-            'Accept': 'application/json, text/javascript, */*; q=0.01',
-            'X-Requested-With': 'XMLHttpRequest',
-            'tribalwars-ajax': '1',
-        })
+        headers = self.get_base_headers()
+        headers.update(self.ajax_headers)
 
-        response = self.request("POST", f"{self.base_url}/{url}", headers=self.get_base_headers(), data=data)
+        response = self.request("POST", f"{self.base_url}/{url}", headers=headers, data=data)
         self.update_after_request(response)
-
-        was_captcha = self.check_captcha(response)
-        if was_captcha:
-            return self.ajax_post_action(village_id, action, data)
+        self.check_captcha(response)
 
         return response
 
@@ -192,18 +401,11 @@ class WebWrapper:
         if params:
             url += "&" + "&".join([f"{key}={value}" for key, value in params.items()])
 
-        headers = self.get_base_headers().copy()
-        headers.update({
-            'Accept': 'application/json, text/javascript, */*; q=0.01',
-            'X-Requested-With': 'XMLHttpRequest',
-            'tribalwars-ajax': '1',
-        })
+        headers = self.get_base_headers()
+        headers.update(self.ajax_headers)
 
-        response = self.request("GET", f"{self.base_url}/{url}", headers=self.get_base_headers())
+        response = self.request("GET", f"{self.base_url}/{url}", headers=headers)
         self.update_after_request(response)
-
-        was_captcha = self.check_captcha(response)
-        if was_captcha:
-            return self.ajax_get_action(village_id, action, params)
+        self.check_captcha(response)
 
         return response
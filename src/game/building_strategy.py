@@ -0,0 +1,84 @@
+import logging
+import threading
+
+from src.core.file_manager import FileManager
+from src.model.village import building_index
+
+logger = logging.getLogger("BuildingStrategy")
+
+
+class BuildingStrategy:
+    """A building strategy compiled from strategy/building/<name>.txt. Compiled strategies are cached and shared by all
+    villages that use them, the cache entry is replaced when the file changes."""
+    cache = {}
+    lock = threading.Lock()
+
+    def __init__(self, name, steps, modified_time):
+        self.name = name
+        self.steps = steps
+        self.modified_time = modified_time
+
+        # For every cursor, the (index, level) of the highest level of every building in the steps before it
+        self.done_levels = []
+        highest = {}
+        for _, level, index in steps:
+            self.done_levels.append(tuple(highest.items()))
+            highest[index] = max(level, highest.get(index, 0))
+        self.done_levels.append(tuple(highest.items()))
+
+    def __len__(self):
+        return len(self.steps)
+
+    @classmethod
+    def load(cls, name):
+        """Get the compiled strategy with the given name, compiling it again if the file changed."""
+        path = f"strategy/building/{name}.txt"
+        modified_time = FileManager.get_modified_time(path)
+
+        strategy = cls.cache.get(name)
+        if strategy is not None and strategy.modified_time == modified_time:
+            return strategy
+
+        with cls.lock:
+            strategy = cls.cache.get(name)
+            if strategy is None or strategy.modified_time != modified_time:
+                strategy = cls.compile(name, path, modified_time)
+                cls.cache[name] = strategy
+
+        return strategy
+
+    @classmethod
+    def compile(cls, name, path, modified_time):
+        """Parse the strategy file into a tuple of (building, level, index) steps, where index is the index of the
+        building in BuildingData.levels."""
+        lines = FileManager.read_lines(path)
+        if lines is None:
+            raise FileNotFoundError(f"Building strategy {name} not found")
+
+        logger.debug(f"Compiling building strategy {name}")
+        steps = []
+        for line in lines:
+            if not line:
+                continue
+            building, level = line.split(":")
+            if building not in building_index:
+                raise ValueError(f"Building strategy {name} has an unknown building {building}")
+            steps.append((building, int(level), building_index[building]))
+
+        return cls(name, tuple(steps), modified_time)
+
+    def advance(self, cursor, buildings):
+        """Move the cursor past the steps that are satisfied by the current building levels. Levels can drop, by
+        catapults or demolition, so the cursor is moved back to the first step that isn't satisfied anymore."""
+        levels = buildings.levels
+        if any(levels[index] < level for index, level in self.done_levels[cursor]):
+            cursor = next(step for step, (_, level, index) in enumerate(self.steps) if levels[index] < level)
+            logger.debug(f"Building levels dropped, strategy {self.name} resumes at step {cursor}")
+
+        while cursor < len(self.steps):
+            _, level, index = self.steps[cursor]
+            if levels[index] < level:
+                break
+            cursor += 1
+
+        return cursor
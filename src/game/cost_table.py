@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+
+from src.core.file_manager import FileManager
+from src.core.request_controller import RequestFailed
+from src.core.web_wrapper import WebWrapper
+from src.model.village import Building, building_index, building_names
+
+logger = logging.getLogger("CostTable")
+
+
+class CostTable:
+    """Wood, stone, iron and population cost and build time of every level of every building of a world, computed from
+    the building config of the world. The tables are arrays indexed by [Building, level], where level is the level that
+    is built. Levels above the maximum level of a building cost infinity.
+
+    Build times also depend on the main building, every level of it makes building 5% faster. The formula doesn't
+    account for world speed or other modifiers, so the build time tables are scaled by what the main screen shows."""
+    cache = {}
+    # When getting the building config of a world failed, by base url. It is tried again after retry_interval seconds
+    failed_at = {}
+    retry_interval = 600
+    lock = threading.Lock()
+    cache_file = "data/building_info.json"
+    resources = ("wood", "stone", "iron")
+    main_factor = 1.05
+
+    def __init__(self, building_info: dict):
+        """Compute the tables from the building config of the world, by building name."""
+        self.max_level = np.array([int(building_info[name]["max_level"]) if name in building_info else 0
+                                   for name in building_names])
+        # The last level is above the maximum level of every building, higher levels are looked up as that level
+        levels = np.arange(int(self.max_level.max()) + 2)
+        # Level 0 is never built, levels above the maximum can't be built
+        unavailable = (levels[np.newaxis, :] > self.max_level[:, np.newaxis]) | (levels == 0)
+
+        def table(base, factor):
+            """base * factor ^ (level - 1) for every building and level."""
+            base = np.array([float(building_info.get(name, {}).get(base, 0)) for name in building_names])
+            factor = np.array([float(building_info.get(name, {}).get(factor, 1)) for name in building_names])
+            return base[:, np.newaxis] * factor[:, np.newaxis] ** (levels - 1)
+
+        for resource in self.resources:
+            costs = np.round(table(resource, f"{resource}_factor"))
+            costs[unavailable] = np.inf
+            setattr(self, resource, costs)
+
+        # The population of a level is the total population of that level minus the total of the level before
+        population = np.round(table("pop", "pop_factor"))
+        population[:, 0] = 0
+        self.pop = np.diff(population, axis=1, prepend=0)
+        self.pop[unavailable] = np.inf
+
+        self.build_time = table("build_time", "build_time_factor")
+        self.build_time[unavailable] = np.inf
+        self.time_scale = np.ones(len(Building))
+        # The buildings of which the build times are calibrated, every building is calibrated once. Buildings that the
+        # world doesn't have can't be
+        self.calibrated = self.max_level == 0
+        self.calibration_lock = threading.Lock()
+
+    @staticmethod
+    def parse_building_info(text):
+        """Parse the xml of interface.php?func=get_building_info into a dict of building name to its config."""
+        root = ElementTree.fromstring(text)
+        return {building.tag: {value.tag: value.text for value in building} for building in root}
+
+    @classmethod
+    def load(cls, web: WebWrapper):
+        """Get the cost table of the world of the web wrapper. The table is computed once per world and shared by all
+        villages. Returns None if the building config of the world is not available, it is tried again after
+        retry_interval seconds."""
+        table = cls.cache.get(web.base_url)
+        if table is not None:
+            return table
+
+        with cls.lock:
+            if web.base_url not in cls.cache:
+                if time.time() - cls.failed_at.get(web.base_url, 0) < cls.retry_interval:
+                    return None
+
+                building_info = cls.load_building_info(web)
+                if building_info is None:
+                    cls.failed_at[web.base_url] = time.time()
+                    return None
+                cls.cache[web.base_url] = cls(building_info)
+
+        return cls.cache[web.base_url]
+
+    @classmethod
+    def load_building_info(cls, web: WebWrapper):
+        """Get the building config of the world from the cache file, or else from the server."""
+        building_info = FileManager.load_json_file(cls.cache_file)
+        if building_info is not None:
+            return building_info
+
+        logger.info("Getting the building config of the world")
+        try:
+            response = web.get_url("interface.php?func=get_building_info")
+            building_info = cls.parse_building_info(response.text)
+        except (RequestFailed, ElementTree.ParseError) as e:
+            logger.warning(f"Building config not available, costs are only known for the next level: {e}")
+            return None
+
+        FileManager.save_json_file(cls.cache_file, building_info)
+        return building_info
+
+    def calibrate(self, building_data: dict, main_level: int):
+        """Scale the build times to the build times of the next levels on the main screen. The table is shared by all
+        villages of the world, every building is calibrated by the first page that shows it."""
+        if self.calibrated.all():
+            return
+
+        with self.calibration_lock:
+            for name, data in building_data.items():
+                index = building_index.get(name)
+                if index is None or self.calibrated[index]:
+                    continue
+                level = int(data.get("level_next", 0))
+                if "build_time" not in data or not 0 < level <= self.max_level[index]:
+                    continue
+
+                predicted = self.build_time[index, level] / self.main_factor ** main_level
+                if predicted > 0:
+                    self.time_scale[index] = float(data["build_time"]) / predicted
+                    self.calibrated[index] = True
+
+    def cost(self, building, level, main_level=0):
+        """Get the cost of building the level of a building, in the format of the building data of the main screen."""
+        index = building_index[building]
+        level = min(level, self.build_time.shape[1] - 1)
+        build_time = self.build_time[index, level] * self.time_scale[index] / self.main_factor ** main_level
+        return {
+            "wood": float(self.wood[index, level]),
+            "stone": float(self.stone[index, level]),
+            "iron": float(self.iron[index, level]),
+            "pop": float(self.pop[index, level]),
+            "build_time": float(build_time),
+        }
@@ -1,55 +1,143 @@
 import logging
 import time
 
+from src.core import metrics
 from src.core.config import Config
-from src.core.events import subscribe_event, Event
-from src.core.file_manager import FileManager
+from src.core.events import subscribe_event, publish_event, Event
 from src.core.page_parser import PageParser
+from src.core.request_controller import RequestFailed
+from src.core.state_store import StateStore
 from src.core.web_wrapper import WebWrapper
-from src.model.village import VillageData
+from src.game.building_strategy import BuildingStrategy
+from src.game.cost_table import CostTable
+from src.game.page_cache import PageCache
+from src.game.resource_projection import ResourceProjection
+from src.model.village import VillageData, Building, building_index
 
 logger = logging.getLogger("BuildingManager")
 
 
 class BuildingManager:
     village_data: VillageData = None
-
-    def __init__(self, village_id: int, village_name: str, config: Config, web: WebWrapper):
+    projection: ResourceProjection = None
+    building_data: dict = None
+    building_queue: [tuple] = []
+    last_fetch_at: float = None
+    wake_times: [float] = []
+    affordable_at: float = None
+    strategy: BuildingStrategy = None
+    cost_table: CostTable = None
+    strategy_cursor: int = 0
+    waiting_for: str = None
+    last_action_updated_data: bool = False
+
+    def __init__(self, village_id: int, village_name: str, config: Config, web: WebWrapper, store: StateStore = None):
         self.village_id = village_id
         self.village_name = village_name
         self.config = config
         self.web = web
+        self.store = store
 
-        global logger
-        logger = logging.getLogger(f"BuildingManager \"{self.village_name}\"")
+        self.logger = logging.getLogger(f"BuildingManager \"{self.village_name}\"")
 
-        subscribe_event(Event.VILLAGE_DATA_UPDATE, self._on_village_data_update)
+        subscribe_event(Event.VILLAGE_DATA_UPDATE, self._on_village_data_update, key=self.village_id)
 
     def _on_village_data_update(self, village_data: VillageData):
-        if village_data.id != self.village_id:
+        self.logger.debug(f"Village data updated")
+        self.village_data = village_data
+        self.projection = ResourceProjection(village_data)
+        self.update_affordable_at()
+
+    def save_state(self):
+        """Buffer the build queue and what the last run learned in the state store."""
+        if self.store is None or self.last_fetch_at is None:
             return
 
-        logger.debug(f"Village data updated")
-        self.village_data = village_data
+        self.store.save_building_state(self.village_id, self.building_queue, self.building_data, self.last_fetch_at,
+                                       self.waiting_for, self.wake_times)
+
+    def restore_state(self, building_queue, state):
+        """Restore the build queue and the state of a previous run from the state store, so that a restart doesn't
+        have to fetch the village before it has work. The village data has to be restored afterwards."""
+        self.building_queue = building_queue
+        self.building_data = state["building_data"]
+        self.last_fetch_at = state["fetched_at"]
+        self.waiting_for = state["waiting_for"]
+        self.wake_times = state["wake_times"]
+
+    def wake_at(self, timestamp):
+        """Ask to be run again at the given unix timestamp."""
+        self.wake_times.append(timestamp)
+
+    def update_affordable_at(self):
+        """Project when the building that the last run was waiting for becomes affordable."""
+        self.affordable_at = None
+        if self.waiting_for is None or self.building_data is None:
+            return
+
+        cost = self.building_data.get(self.waiting_for)
+        if cost is not None:
+            self.affordable_at = self.projection.affordable_at(cost)
+
+    def next_run_at(self, default):
+        """Get the earliest unix timestamp at which running again is useful."""
+        wake_times = self.wake_times if self.affordable_at is None else self.wake_times + [self.affordable_at]
+        return min(wake_times, default=default)
+
+    def has_work(self):
+        """Check, without fetching a page, if running now is useful based on what the last run learned."""
+        if self.last_fetch_at is None:
+            return True
+
+        now = time.time()
+        if now - self.last_fetch_at >= self.config.get("building_manager.max_idle", 3600):
+            return True
+
+        return self.next_run_at(now) <= now
+
+    def run(self, pages: PageCache):
+        self.wake_times = []
+        self.waiting_for = None
+        self.affordable_at = None
 
-    def run(self):
         if self.village_data is None:
-            logger.warning("Village data is not available")
+            self.logger.warning("Village data is not available")
             return
 
         # Get data needed
-        response = self.web.get_screen("main", params={"village": self.village_id})
+        response = pages.get("main")
         max_queue_size = self.config.get("building_manager.queue_size", 2)
-        building_queue = PageParser.get_building_queue(response)
+        building_queue = list(PageParser.get_building_queue(response))
         building_data = PageParser.get_building_data(response)
+        self.building_queue = building_queue
+        self.building_data = building_data
+        self.last_fetch_at = time.time()
+        self.cost_table = CostTable.load(self.web)
+        if self.cost_table is not None:
+            self.cost_table.calibrate(building_data, self.village_data.buildings.get_level(Building.MAIN))
 
         # Check if we can finish any building early to make space for new ones
         finish_enabled = self.config.get("building_manager.finish_enabled", True)
         finish_early = PageParser.get_finish_early_id(response)  # (id, finish_time)
         current_time = time.time()
-        if finish_enabled and finish_early is not None and current_time > finish_early[1]:
-            self.finish_early(finish_early[0])
-            self.run()
+        if finish_enabled and finish_early is not None:
+            if current_time > finish_early[1]:
+                if self.finish_early(finish_early[0]):
+                    # The first task in the queue is done now
+                    building_queue.pop(0)
+                    if not self.last_action_updated_data or self.cost_table is None:
+                        # The levels or the costs of the page are outdated, fetch it again
+                        pages.invalidate("main")
+                        self.run(pages)
+                        return
+                    # A finished level of the main building makes everything build faster
+                    self.update_costs(building_data)
+            else:
+                self.wake_at(finish_early[1])
+
+        # A slot opens up when the first task in the queue is done
+        if building_queue:
+            self.wake_at(min(unix for _, _, unix in building_queue))
 
         upgrade_enabled = self.config.get("building_manager.upgrade_enabled", True)
         if not upgrade_enabled:
@@ -57,16 +145,56 @@ class BuildingManager:
 
         # Check if we can start any new buildings
         if len(building_queue) >= max_queue_size:
-            logger.info(f"Building queue is full, max size: {max_queue_size}")
+            self.logger.info(f"Building queue is full, max size: {max_queue_size}")
             return
 
         # Find next task
         task = self.find_next_task(building_queue, building_data)
         if task is None:
-            logger.info("No upgrades to do at the moment")
+            self.logger.info("No upgrades to do at the moment")
+            self.update_affordable_at()
+            return
+
+        if not self.queue_upgrade(task):
             return
 
-        self.queue_upgrade(task)
+        # Keep the queue and the costs up to date locally instead of fetching the page again
+        build_time = self.get_cost(task[0], task[1], building_data).get("build_time", 3600)
+        start_time = max([unix for _, _, unix in building_queue], default=current_time)
+        building_queue.append((task[0], task[1], int(start_time + build_time)))
+        if self.cost_table is not None:
+            building_data[task[0]] = {**self.get_cost(task[0], task[1] + 1, building_data), "level_next": task[1] + 1}
+        else:
+            # The cost of the level after this one is only known from the page, which is outdated now
+            building_data.pop(task[0], None)
+            pages.invalidate("main")
+        if len(building_queue) < max_queue_size:
+            # There is still room in the queue, try again as soon as possible
+            self.wake_at(current_time)
+        else:
+            self.wake_at(min(unix for _, _, unix in building_queue))
+
+    def apply_action_response(self, response):
+        """Update the village data from the game data in the response of an ajax action, and remember whether the
+        response carried game data at all."""
+        village_data = PageParser.get_village_data(response)
+        self.last_action_updated_data = village_data is not None
+        if village_data is not None:
+            publish_event(Event.VILLAGE_DATA_UPDATE, village_data, key=self.village_id)
+
+    def update_costs(self, building_data):
+        """Compute the costs of the next levels of the main screen again from the cost table, with the current level of
+        the main building."""
+        main_level = self.village_data.buildings.get_level(Building.MAIN)
+        for building, data in building_data.items():
+            index = building_index.get(building)
+            level = int(data.get("level_next", 0))
+            if index is not None and 0 < level <= self.cost_table.max_level[index]:
+                building_data[building] = {**data, **self.cost_table.cost(building, level, main_level)}
+
+    def record_action(self, action, building=None, level=None, success=True):
+        if self.store is not None:
+            self.store.record_action(self.village_id, action, building, level, success)
 
     def queue_upgrade(self, task):
         data = {
@@ -77,12 +205,20 @@ class BuildingManager:
             'h': self.web.last_h
         }
 
-        response = self.web.ajax_post_action(self.village_id, "upgrade_building", data)
-        if response.status_code != 200:
-            logger.error(f"Failed to queue upgrade for building {task[0]}")
-            return
+        try:
+            response = self.web.ajax_post_action(self.village_id, "upgrade_building", data)
+            error = PageParser.get_ajax_error(response)
+        except RequestFailed as e:
+            error = str(e)
+        if error:
+            self.logger.error(f"Failed to queue upgrade for building {task[0]}: {error}")
+            self.record_action("upgrade_building", task[0], task[1], success=False)
+            return False
 
-        logger.info(f"Queued upgrade for building {task[0]} to level {task[1]}")
+        self.apply_action_response(response)
+        self.record_action("upgrade_building", task[0], task[1])
+        self.logger.info(f"Queued upgrade for building {task[0]} to level {task[1]}")
+        return True
 
     def finish_early(self, finish_early_id):
         params = {
@@ -91,23 +227,37 @@ class BuildingManager:
             'h': self.web.last_h
         }
 
-        response = self.web.ajax_get_action(self.village_id, "build_order_reduce", params)
-        if response.status_code != 200:
-            logger.error(f"Failed to finish upgrade early")
+        try:
+            response = self.web.ajax_get_action(self.village_id, "build_order_reduce", params)
+            error = PageParser.get_ajax_error(response)
+        except RequestFailed as e:
+            error = str(e)
+        if error:
+            self.logger.error(f"Failed to finish upgrade early: {error}")
+            self.record_action("build_order_reduce", success=False)
             return False
 
-        logger.info(f"Finished upgrade early")
+        self.apply_action_response(response)
+        self.record_action("build_order_reduce")
+        self.logger.info(f"Finished upgrade early")
         return True
 
+    @metrics.find_next_task_seconds.timed()
     def find_next_task(self, building_queue, building_data):
-        strategy = self.config.get_village(self.village_id, "strategy.building", "purple_predator")
-        lines = FileManager.read_lines(f"strategy/building/{strategy}.txt")
+        strategy_name = self.config.get_village(self.village_id, "strategy.building", "purple_predator")
+        strategy = BuildingStrategy.load(strategy_name)
+        if strategy is not self.strategy:
+            self.strategy = strategy
+            self.strategy_cursor = 0
+
+        # Skip the steps that are already done
+        self.strategy_cursor = strategy.advance(self.strategy_cursor, self.village_data.buildings)
 
-        # Parse strategy file
         tries = 0
-        for building, target_level in [line.split(":") for line in lines]:
-            current_level = self.village_data.buildings.get_level(building)
-            target_level = int(target_level)
+        levels = self.village_data.buildings.levels
+        for step in range(self.strategy_cursor, len(strategy)):
+            building, target_level, index = strategy.steps[step]
+            current_level = levels[index]
 
             if target_level <= current_level:
                 continue
@@ -123,7 +273,7 @@ class BuildingManager:
                         current_level = queued_level
 
             if should_skip:
-                logger.debug(f"Skipping {building} because it's already in queue")
+                self.logger.debug(f"Skipping {building} because it's already in queue")
                 continue
 
             # Check if building is already at target level
@@ -133,14 +283,16 @@ class BuildingManager:
 
                 # Add tasks
                 for i in range(diff):
-                    logger.debug(
+                    self.logger.debug(
                         f"Building {building} level {current_level + i} -> {current_level + i + 1}")
 
-                    if self.can_afford(building, building_data):
+                    if self.can_afford(building, current_level + i + 1, building_data):
                         return building, current_level + i + 1
                     else:
-                        logger.debug(
+                        self.logger.debug(
                             f"Can't afford building {building} level {current_level + i + 1} or it's not available")
+                        if self.waiting_for is None:
+                            self.waiting_for = building
                         tries += 1
                         should_skip = True
 
@@ -149,13 +301,19 @@ class BuildingManager:
             return None
         return None
 
-    def can_afford(self, building, building_data):
+    def get_cost(self, building, level, building_data):
+        """Get the cost of building a level of a building. The main screen only shows the costs of the next levels,
+        other levels are looked up in the cost table of the world. Returns None if the building is not available."""
         data = building_data.get(building)
+        if data is None or self.cost_table is None or int(data.get("level_next", level)) == level:
+            return data
+
+        return self.cost_table.cost(building, level, self.village_data.buildings.get_level(Building.MAIN))
+
+    def can_afford(self, building, level, building_data):
+        data = self.get_cost(building, level, building_data)
         if data is None:
             # Building is not available
             return False
 
-        return data.get("pop") <= self.village_data.pop \
-            and data.get("wood") <= self.village_data.wood \
-            and data.get("stone") <= self.village_data.stone \
-            and data.get("iron") <= self.village_data.iron
+        return self.projection.can_afford(data)
@@ -0,0 +1,26 @@
+from src.core.web_wrapper import WebWrapper
+
+
+class PageCache:
+    """The screens of a village that were fetched during one cycle. All managers of the village share these pages, so
+    every screen is fetched at most once per cycle."""
+    # What the managers need of a screen besides the game data, a screen of which the json lacks it is fetched as html
+    required = {
+        "main": ("building_data",),
+    }
+
+    def __init__(self, village_id: int, web: WebWrapper):
+        self.village_id = village_id
+        self.web = web
+        self.pages = {}
+
+    def get(self, screen):
+        """Get the screen, fetching it if it wasn't fetched during this cycle yet."""
+        if screen not in self.pages:
+            self.pages[screen] = self.web.get_screen(screen, params={"village": self.village_id},
+                                                     required=self.required.get(screen, ()))
+        return self.pages[screen]
+
+    def invalidate(self, screen):
+        """Forget a screen, for when an action made it outdated and local state can't be updated instead."""
+        self.pages.pop(screen, None)
@@ -0,0 +1,56 @@
+import time
+
+from src.model.village import VillageData
+
+
+class ResourceProjection:
+    """Extrapolates the resources of a village from its last snapshot with the production rates, capped at the storage.
+    This allows deciding whether something is affordable without fetching a page."""
+    resources = ("wood", "stone", "iron")
+
+    def __init__(self, village_data: VillageData):
+        self.village_data = village_data
+        # last_res_tick is the time of the snapshot in milliseconds
+        self.snapshot_time = village_data.last_res_tick / 1000
+
+    def resource_at(self, resource, timestamp=None):
+        """Get the projected amount of a resource at the given unix timestamp (defaults to now)."""
+        timestamp = time.time() if timestamp is None else timestamp
+        amount = getattr(self.village_data, f"{resource}_float")
+        production = getattr(self.village_data, f"{resource}_prod")
+        amount += production * max(0.0, timestamp - self.snapshot_time)
+        return min(amount, self.village_data.storage_max)
+
+    def has_population(self, cost):
+        """Check if there is enough free population for the cost. Population doesn't grow over time."""
+        return cost.get("pop", 0) <= self.village_data.pop_max - self.village_data.pop
+
+    def can_afford(self, cost, timestamp=None):
+        """Check if the cost (a dict with wood, stone, iron and pop) is affordable at the given unix timestamp."""
+        if not self.has_population(cost):
+            return False
+
+        return all(cost.get(resource, 0) <= self.resource_at(resource, timestamp) for resource in self.resources)
+
+    def affordable_at(self, cost):
+        """Get the unix timestamp at which the cost becomes affordable, or None if waiting won't make it affordable
+        (not enough population, not enough storage or no production)."""
+        if not self.has_population(cost):
+            return None
+
+        affordable_at = self.snapshot_time
+        for resource in self.resources:
+            needed = cost.get(resource, 0)
+            if needed > self.village_data.storage_max:
+                return None
+
+            missing = needed - getattr(self.village_data, f"{resource}_float")
+            if missing <= 0:
+                continue
+
+            production = getattr(self.village_data, f"{resource}_prod")
+            if production <= 0:
+                return None
+            affordable_at = max(affordable_at, self.snapshot_time + missing / production)
+
+        return affordable_at
@@ -1,11 +1,14 @@
 import logging
 import math
 
+from src.core import metrics
 from src.core.config import Config
-from src.core.events import publish_event, Event
+from src.core.events import subscribe_event, publish_event, Event
 from src.core.page_parser import PageParser
+from src.core.state_store import StateStore
 from src.core.web_wrapper import WebWrapper
 from src.game.managers.building_manager import BuildingManager
+from src.game.page_cache import PageCache
 from src.model.village import VillageData
 
 logger = logging.getLogger("Village")
@@ -13,40 +16,72 @@ logger = logging.getLogger("Village")
 
 class Village:
     village_data: VillageData = None
+    run_count: int = 0
 
-    def __init__(self, village_config, config: Config, web: WebWrapper):
+    def __init__(self, village_config, config: Config, web: WebWrapper, store: StateStore = None):
         self.config = config
         self.village_config = village_config
         self.village_id = village_config["id"]
         self.village_name = village_config["name"]
         self.web = web
 
-        global logger
-        logger = logging.getLogger(f"Village \"{self.village_config['name']}\"")
+        self.logger = logging.getLogger(f"Village \"{self.village_config['name']}\"")
 
-        self.building_manager = BuildingManager(self.village_id, self.village_name, self.config, self.web)
+        self.building_manager = BuildingManager(self.village_id, self.village_name, self.config, self.web, store)
+
+        # Ajax actions and the bulk refresh update the village data as well
+        subscribe_event(Event.VILLAGE_DATA_UPDATE, self._on_village_data_update, key=self.village_id)
+
+    def _on_village_data_update(self, village_data: VillageData):
+        self.village_data = village_data
 
     def run(self):
-        logger.info("Starting run")
-        self.village_data = self.get_data()
-        self.log_info()
-        self.building_manager.run()
+        if not self.building_manager.has_work():
+            self.logger.info("Nothing to do yet, skipping run")
+            return
+
+        self.logger.info("Starting run")
+        self.run_count += 1
+        metrics.village_runs_total.inc()
+        with metrics.village_run_seconds.time():
+            pages = PageCache(self.village_id, self.web)
+            self.village_data = self.get_data(pages)
+            if self.village_data is None:
+                self.logger.warning("Village data is not available")
+                return
+
+            self.log_info()
+            self.building_manager.run(pages)
+            self.building_manager.save_state()
+
+    def restore(self, village_data, building_queue, state):
+        """Restore the village from the state store after a restart."""
+        if state is not None:
+            self.building_manager.restore_state(building_queue, state)
+        if village_data is not None:
+            self.village_data = village_data
+            publish_event(Event.VILLAGE_DATA_UPDATE, village_data, key=self.village_id)
+
+    def next_run_at(self, default):
+        """Get the earliest unix timestamp at which running this village again is useful."""
+        return self.building_manager.next_run_at(default)
 
     def log_info(self):
         wood_prod_hour = math.floor(self.village_data.wood_prod * 60 * 60)
         stone_prod_hour = math.floor(self.village_data.stone_prod * 60 * 60)
         iron_prod_hour = math.floor(self.village_data.iron_prod * 60 * 60)
 
-        logger.info(
+        self.logger.info(
             f"Wood: {self.village_data.wood}({wood_prod_hour}/h), "
             f"Stone: {self.village_data.stone}({stone_prod_hour}/h), "
             f"Iron: {self.village_data.iron}({iron_prod_hour}/h)")
-        logger.info(f"Population: {self.village_data.pop}/{self.village_data.pop_max}")
-        logger.info(f"Max storage: {self.village_data.storage_max}")
-
-    def get_data(self):
-        logger.debug("Getting village data")
-        result = self.web.get_screen("overview_village", params={"village": self.village_id})
-        village_data = PageParser.get_village_data_from_village_overview(result)
-        publish_event(Event.VILLAGE_DATA_UPDATE, village_data)
+        self.logger.info(f"Population: {self.village_data.pop}/{self.village_data.pop_max}")
+        self.logger.info(f"Max storage: {self.village_data.storage_max}")
+
+    def get_data(self, pages: PageCache):
+        """Get the village data from the main screen, which the building manager needs as well."""
+        self.logger.debug("Getting village data")
+        village_data = PageParser.get_village_data(pages.get("main"))
+        if village_data is not None:
+            publish_event(Event.VILLAGE_DATA_UPDATE, village_data, key=self.village_id)
         return village_data
@@ -1,33 +1,70 @@
-from dataclasses import dataclass
+from array import array
+from dataclasses import dataclass, fields
+from enum import IntEnum
+from operator import itemgetter
+
+
+class Building(IntEnum):
+    """The buildings of a village, the value is the index of the building in BuildingData.levels."""
+    MAIN = 0
+    BARRACKS = 1
+    STABLE = 2
+    GARAGE = 3
+    WATCHTOWER = 4
+    SNOB = 5
+    SMITH = 6
+    PLACE = 7
+    STATUE = 8
+    MARKET = 9
+    WOOD = 10
+    STONE = 11
+    IRON = 12
+    FARM = 13
+    STORAGE = 14
+    WALL = 15
+
+
+# Building names as used by the game, in the order of Building
+building_names = tuple(building.name.lower() for building in Building)
+# Index in BuildingData.levels by building name and by Building, as plain ints because indexing with those is faster
+building_index = {
+    **{name: index for index, name in enumerate(building_names)},
+    **{building: int(building) for building in Building},
+}
+get_building_levels = itemgetter(*building_names)
 
 
-@dataclass
 class BuildingData:
-    main: int
-    barracks: int
-    stable: int
-    garage: int
-    watchtower: int
-    snob: int
-    smith: int
-    place: int
-    statue: int
-    market: int
-    wood: int
-    stone: int
-    iron: int
-    farm: int
-    storage: int
-    wall: int
+    """The levels of the buildings of a village in an int array indexed by Building."""
+    __slots__ = ("levels",)
 
-    def get_level(self, building_name):
+    def __init__(self, levels: array):
+        self.levels = levels
+
+    @staticmethod
+    def from_json(buildings):
+        """Create the building data from the buildings of the game data, which has the levels as strings."""
+        return BuildingData(array("i", map(int, get_building_levels(buildings))))
+
+    def to_json(self):
+        return dict(zip(building_names, self.levels))
+
+    def get_level(self, building):
+        """Get the level of a building by name or Building."""
         try:
-            return getattr(self, building_name)
-        except AttributeError:
-            raise AttributeError(f"Building {building_name} does not exist")
+            return self.levels[building_index[building]]
+        except KeyError:
+            raise AttributeError(f"Building {building} does not exist") from None
 
+    def __eq__(self, other):
+        return isinstance(other, BuildingData) and self.levels == other.levels
 
-@dataclass
+    def __repr__(self):
+        levels = ", ".join(f"{name}={level}" for name, level in self.to_json().items())
+        return f"BuildingData({levels})"
+
+
+@dataclass(slots=True)
 class VillageData:
     id: int
     name: str
@@ -59,9 +96,18 @@ class VillageData:
 
     @staticmethod
     def from_json(data):
-        json_data = data.copy()
+        """Create the village data from the game data, without copying it. Keys that aren't fields are ignored."""
+        values = get_village_values(data)
+        return VillageData(*values[:buildings_field], BuildingData.from_json(values[buildings_field]),
+                           *values[buildings_field + 1:])
+
+    def to_json(self):
+        """Get the village data in the format of the game data, so that from_json can read it back."""
+        data = {name: getattr(self, name) for name in village_fields}
+        data["buildings"] = self.buildings.to_json()
+        return data
 
-        json_data['buildings'] = {key: int(value) for key, value in json_data['buildings'].items()}
-        json_data["buildings"] = BuildingData(**json_data["buildings"])
 
-        return VillageData(**json_data)
+village_fields = tuple(field.name for field in fields(VillageData))
+buildings_field = village_fields.index("buildings")
+get_village_values = itemgetter(*village_fields)
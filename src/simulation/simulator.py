@@ -0,0 +1,253 @@
+import math
+from array import array
+from dataclasses import dataclass
+
+from src.core.config import Config
+from src.game.building_strategy import BuildingStrategy
+from src.game.cost_table import CostTable
+from src.game.managers.building_manager import BuildingManager
+from src.game.resource_projection import ResourceProjection
+from src.model.village import VillageData, BuildingData, Building, building_names
+
+# Buildings that need other buildings first, the main screen doesn't offer them before that
+requirements = {
+    "barracks": {"main": 3},
+    "stable": {"main": 10, "barracks": 5, "smith": 5},
+    "garage": {"main": 10, "smith": 10},
+    "watchtower": {"main": 5, "farm": 5},
+    "snob": {"main": 20, "smith": 20, "market": 10},
+    "smith": {"main": 5, "barracks": 1},
+    "market": {"main": 3, "storage": 2},
+    "wall": {"barracks": 1},
+}
+
+# Levels of a new village
+start_levels = {"main": 1, "farm": 1, "storage": 1}
+
+
+def production(level, speed=1.0):
+    """Production of a resource building in resources per second."""
+    return (5 if level == 0 else 30 * 1.163118 ** (level - 1)) * speed / 3600
+
+
+def storage_max(level):
+    return math.floor(1000 * 1.2294934 ** (level - 1))
+
+
+def pop_max(level):
+    return math.floor(240 * 1.172103 ** (level - 1))
+
+
+@dataclass(frozen=True)
+class Variant:
+    """Building manager settings to simulate a strategy with."""
+    strategy: str
+    queue_size: int = 2
+    lookahead: int = 2
+    finish_enabled: bool = True
+
+
+class SimulationConfig(Config):
+    """Config of a single simulated village, built from a variant instead of config.yaml."""
+
+    def __init__(self, variant: Variant):
+        super().__init__({
+            "building_manager": {
+                "queue_size": variant.queue_size,
+                "lookahead": variant.lookahead,
+                "finish_enabled": variant.finish_enabled,
+                "upgrade_enabled": True,
+            },
+            "villages": [{"id": VillageSimulation.village_id, "strategy": {"building": variant.strategy}}],
+        })
+
+
+class SimulatedProjection(ResourceProjection):
+    """Projection of which the present is the simulated time of the snapshot instead of the real time."""
+
+    def resource_at(self, resource, timestamp=None):
+        return super().resource_at(resource, self.snapshot_time if timestamp is None else timestamp)
+
+
+class SimulatedBuildingData:
+    """The building data of the main screen of a simulated village: the cost of the next level of every building that
+    is available, taking the queue into account. Costs are computed when they are asked for."""
+
+    def __init__(self, simulation):
+        self.simulation = simulation
+
+    def get(self, building, default=None):
+        simulation = self.simulation
+        levels = simulation.levels
+        for required, level in requirements.get(building, {}).items():
+            if simulation.get_level(required) < level:
+                return default
+
+        level_next = simulation.get_queued_level(building) + 1
+        return {**simulation.cost_table.cost(building, level_next, levels[Building.MAIN]), "level_next": level_next}
+
+
+class VillageSimulation:
+    """Discrete-event simulation of the building manager of one village. Time jumps from event to event (an order that
+    finishes, or the moment the resources for the next task are produced), so weeks of game time take seconds.
+
+    The decisions are made by BuildingManager.find_next_task on the simulated state, like the bot would make them."""
+    village_id = 1
+    # Orders can be finished for free when they have less than this many seconds to go
+    finish_free = 180
+
+    def __init__(self, variant: Variant, cost_table: CostTable, resources=(500, 500, 500), speed=1.0, margin=2):
+        self.variant = variant
+        self.cost_table = cost_table
+        self.speed = speed
+        self.margin = margin
+
+        self.levels = array("i", [start_levels.get(name, 0) for name in building_names])
+        self.resources = [float(amount) for amount in resources]
+        self.queue = []  # [building, level, build time], the first order started at queue_started_at
+        self.queue_started_at = 0.0
+        self.time = 0.0
+
+        self.strategy = BuildingStrategy.load(variant.strategy)
+        self.manager = BuildingManager(self.village_id, variant.strategy, SimulationConfig(variant), None)
+        self.manager.cost_table = cost_table
+        self.building_data = SimulatedBuildingData(self)
+
+        self.orders = 0
+        self.spent = [0.0, 0.0, 0.0]
+        self.idle_time = 0.0
+        self.completed_at = None
+
+    def get_level(self, building):
+        return self.levels[Building[building.upper()]]
+
+    def get_queued_level(self, building):
+        """Get the level the building will have when the queue is done."""
+        level = self.get_level(building)
+        for queued_building, queued_level, _ in self.queue:
+            if queued_building == building:
+                level = queued_level
+        return level
+
+    def get_production(self):
+        return [production(self.levels[building], self.speed) for building in (Building.WOOD, Building.STONE,
+                                                                               Building.IRON)]
+
+    def get_pop(self):
+        """Get the population that is used by the buildings, including the orders in the queue."""
+        return sum(self.cost_table.pop[index, 1:self.get_queued_level(name) + 1].sum()
+                   for index, name in enumerate(building_names))
+
+    def get_village_data(self):
+        wood_prod, stone_prod, iron_prod = self.get_production()
+        wood, stone, iron = self.resources
+        return VillageData(
+            id=self.village_id, name="Simulation", display_name="Simulation",
+            wood=int(wood), wood_prod=wood_prod, wood_float=wood,
+            stone=int(stone), stone_prod=stone_prod, stone_float=stone,
+            iron=int(iron), iron_prod=iron_prod, iron_float=iron,
+            pop=int(self.get_pop()), pop_max=pop_max(self.levels[Building.FARM]), x=0, y=0, trader_away=0,
+            storage_max=storage_max(self.levels[Building.STORAGE]), bonus_id=None, bonus=None,
+            buildings=BuildingData(array("i", self.levels)), player_id=0, modifications=0, points=0,
+            last_res_tick=self.time * 1000, coord="0|0", is_farm_upgradable=True)
+
+    def get_finish_at(self):
+        """Get the time at which the first order is done, or None if the queue is empty."""
+        if not self.queue:
+            return None
+
+        finish_at = self.queue_started_at + self.queue[0][2]
+        if self.variant.finish_enabled:
+            # The bot finishes the order as soon as that is free
+            finish_at = max(self.queue_started_at, finish_at - self.finish_free)
+        return finish_at
+
+    def advance(self, until):
+        """Produce the resources up to the given time and complete the orders that are done by then."""
+        while self.time < until:
+            finish_at = self.get_finish_at()
+            step_until = until if finish_at is None else min(until, max(finish_at, self.time))
+            elapsed = step_until - self.time
+            capacity = storage_max(self.levels[Building.STORAGE])
+            for index, amount in enumerate(self.get_production()):
+                self.resources[index] = min(capacity, self.resources[index] + amount * elapsed)
+            if not self.queue:
+                self.idle_time += elapsed
+            self.time = step_until
+
+            if finish_at is not None and finish_at <= self.time:
+                building, level, _ = self.queue.pop(0)
+                self.levels[Building[building.upper()]] = level
+                self.queue_started_at = self.time
+
+    def order_next(self):
+        """Let the building manager pick the next task and order it. Returns whether something was ordered."""
+        if len(self.queue) >= self.variant.queue_size:
+            return False
+
+        village_data = self.get_village_data()
+        self.manager.village_data = village_data
+        self.manager.projection = SimulatedProjection(village_data)
+        self.manager.waiting_for = None
+        queue = [(building, level, 0) for building, level, _ in self.queue]
+        task = self.manager.find_next_task(queue, self.building_data)
+        if task is None:
+            return False
+
+        building, level = task
+        cost = self.building_data.get(building)
+        for index, resource in enumerate(CostTable.resources):
+            self.resources[index] -= cost[resource]
+            self.spent[index] += cost[resource]
+        if not self.queue:
+            self.queue_started_at = self.time
+        self.queue.append([building, cost["level_next"], cost["build_time"] / self.speed])
+        self.orders += 1
+        return True
+
+    def next_event_at(self):
+        """Get the time at which running the building manager again is useful, or None if nothing will change."""
+        times = []
+        finish_at = self.get_finish_at()
+        if finish_at is not None:
+            times.append(finish_at)
+
+        waiting_for = self.manager.waiting_for
+        if waiting_for is not None and len(self.queue) < self.variant.queue_size:
+            cost = self.building_data.get(waiting_for)
+            affordable_at = self.manager.projection.affordable_at(cost) if cost is not None else None
+            if affordable_at is not None:
+                times.append(affordable_at)
+
+        return min(times, default=None)
+
+    def run(self, duration):
+        """Simulate the given number of seconds of game time and return the results."""
+        while self.time < duration:
+            while self.order_next():
+                pass
+
+            if self.completed_at is None and self.strategy.advance(0, BuildingData(self.levels)) == len(self.strategy):
+                self.completed_at = self.time
+
+            next_event_at = self.next_event_at()
+            if next_event_at is None:
+                # Nothing will change anymore
+                self.advance(duration)
+                break
+            self.advance(min(duration, max(next_event_at, self.time) + self.margin))
+
+        return self.get_results()
+
+    def get_results(self):
+        return {
+            "steps_done": self.strategy.advance(0, BuildingData(self.levels)),
+            "steps": len(self.strategy),
+            "completed_at": self.completed_at,
+            "orders": self.orders,
+            "levels": sum(self.levels),
+            "wood_spent": self.spent[0],
+            "stone_spent": self.spent[1],
+            "iron_spent": self.spent[2],
+            "idle_fraction": self.idle_time / self.time if self.time else 0.0,
+        }
@@ -0,0 +1,126 @@
+"""Simulate a building strategy for many villages and building manager settings at once, on a pool of processes.
+
+Run it from the project root with: python -m src.simulation.sweep --strategy purple_predator --queue-size 1 2 3
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from src.core.file_manager import FileManager
+from src.game.cost_table import CostTable
+from src.simulation.simulator import Variant, VillageSimulation
+
+logger = logging.getLogger("Sweep")
+
+cost_table = None
+
+
+def init_worker(building_info):
+    """Compute the cost table once per worker process."""
+    global cost_table
+    cost_table = CostTable(building_info)
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def simulate(variant, seed, duration, resources, speed):
+    """Simulate one village. The seed varies the starting resources, so the villages of a variant differ."""
+    rng = random.Random(seed)
+    start_resources = [amount * rng.uniform(0.5, 1.5) for amount in resources]
+    simulation = VillageSimulation(variant, cost_table, start_resources, speed)
+    return simulation.run(duration)
+
+
+def summarize(variant, results, duration):
+    """Combine the results of the villages of a variant."""
+    completed_at = np.array([result["completed_at"] if result["completed_at"] is not None else np.nan
+                             for result in results], dtype=float)
+    steps_done = np.array([result["steps_done"] for result in results])
+    return {
+        "variant": variant.__dict__,
+        "villages": len(results),
+        "steps": results[0]["steps"],
+        "steps_done_mean": float(steps_done.mean()),
+        "steps_done_min": int(steps_done.min()),
+        "completed": int(np.count_nonzero(~np.isnan(completed_at))),
+        "completed_days_median": float(np.nanmedian(completed_at) / 86400) if np.any(~np.isnan(completed_at)) else None,
+        "levels_mean": float(np.mean([result["levels"] for result in results])),
+        "orders_mean": float(np.mean([result["orders"] for result in results])),
+        "idle_fraction_mean": float(np.mean([result["idle_fraction"] for result in results])),
+        "days": duration / 86400,
+    }
+
+
+def sweep(variants, villages, duration, building_info, resources=(500, 500, 500), speed=1.0, processes=None):
+    """Simulate every variant for the given number of villages and return a summary per variant."""
+    jobs = [(variant, seed) for variant in variants for seed in range(villages)]
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(building_info,)) as executor:
+        futures = [executor.submit(simulate, variant, seed, duration, resources, speed) for variant, seed in jobs]
+        results = [future.result() for future in futures]
+
+    summaries = []
+    for index, variant in enumerate(variants):
+        summaries.append(summarize(variant, results[index * villages:(index + 1) * villages], duration))
+    return summaries
+
+
+def parse_bool(value):
+    if value.lower() not in ("true", "false"):
+        raise argparse.ArgumentTypeError("Expected true or false")
+    return value.lower() == "true"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate building strategies offline")
+    parser.add_argument("--strategy", nargs="+", default=["purple_predator"],
+                        help="names of strategies in strategy/building")
+    parser.add_argument("--days", type=float, default=14, help="days of game time to simulate")
+    parser.add_argument("--villages", type=int, default=8, help="villages to simulate per variant")
+    parser.add_argument("--queue-size", type=int, nargs="+", default=[2])
+    parser.add_argument("--lookahead", type=int, nargs="+", default=[2])
+    parser.add_argument("--finish-enabled", type=parse_bool, nargs="+", default=[True])
+    parser.add_argument("--speed", type=float, default=1.0, help="speed of the world")
+    parser.add_argument("--building-info", default=CostTable.cache_file,
+                        help="building config of the world, as saved by the bot")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    building_info = FileManager.load_json_file(args.building_info)
+    if building_info is None:
+        raise FileNotFoundError(f"{args.building_info} not found, run the bot once to download the building config of "
+                                f"the world")
+
+    variants = [Variant(*values)
+                for values in itertools.product(args.strategy, args.queue_size, args.lookahead, args.finish_enabled)]
+    logger.info(f"Simulating {len(variants)} variants of {args.villages} villages for {args.days} days")
+    start = time.perf_counter()
+    summaries = sweep(variants, args.villages, args.days * 86400, building_info, speed=args.speed,
+                      processes=args.processes)
+    logger.info(f"Simulated {len(variants) * args.villages} villages in {time.perf_counter() - start:.1f} seconds")
+
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+        return
+
+    print(f"{'strategy':>16} {'queue':>5} {'ahead':>5} {'finish':>6} {'steps done':>11} {'done in days':>12} "
+          f"{'levels':>7} {'idle':>6}")
+    for summary in summaries:
+        variant = summary["variant"]
+        completed = summary["completed_days_median"]
+        print(f"{variant['strategy']:>16} {variant['queue_size']:>5} {variant['lookahead']:>5} "
+              f"{str(variant['finish_enabled']):>6} {summary['steps_done_mean']:>6.1f}/{summary['steps']:<4} "
+              f"{'-' if completed is None else f'{completed:.1f}':>12} {summary['levels_mean']:>7.1f} "
+              f"{summary['idle_fraction_mean']:>6.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+import coloredlogs
+
+from src.core.file_manager import FileManager
+
+logger = logging.getLogger("Supervisor")
+
+# Exit code of a worker of which the session expired, it is restarted once the cookies of its workspace change
+session_expired_exit_code = 3
+
+
+def run_account(name, workspace, reports, report_interval):
+    """Run the bot of one account in its own process. Everything the bot writes stays in the workspace, and the session
+    and rate limiter belong to this process only."""
+    from src.bot import Bot
+    from src.core.config import Config
+    from src.core.input import Input
+    from src.core.time_utils import TimeUtils
+    from src.core.web_wrapper import SessionExpired
+
+    coloredlogs.install(level=logging.INFO, fmt=f"%(asctime)s [{name}] %(name)s %(levelname)s: %(message)s")
+    logging.getLogger("requests").setLevel(logging.WARNING)
+    logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+    FileManager.set_workspace(workspace)
+    TimeUtils.show_countdown = False
+    Input.interactive = False
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    # The supervisor stops its daemon workers with SIGTERM, which would otherwise end the process without running the
+    # finally below and lose the changes to the config that are still written behind
+    signal.signal(signal.SIGTERM, stop)
+
+    config = Config()
+    coloredlogs.set_level(config.get("bot.log_level", "INFO"))
+    try:
+        bot = Bot(config)
+    except SessionExpired as e:
+        logger.error(str(e))
+        sys.exit(session_expired_exit_code)
+
+    def report():
+        while True:
+            reports.put({"account": name, "time": time.time(), **bot.health()})
+            time.sleep(report_interval)
+
+    threading.Thread(target=report, name="Reporter", daemon=True).start()
+    try:
+        bot.start()
+    except SessionExpired as e:
+        logger.error(str(e))
+        sys.exit(session_expired_exit_code)
+    finally:
+        # Worker processes that are forked exit without running exit handlers
+        config.flush()
+
+
+class Supervisor:
+    """Runs every account of accounts.yaml in its own worker process, restarts workers that stop and logs the combined
+    health and throughput."""
+    accounts_file = "accounts.yaml"
+
+    def __init__(self):
+        settings = FileManager.load_yaml_file(self.accounts_file)
+        if settings is None:
+            raise FileNotFoundError(f"{self.accounts_file} not found, see accounts.example.yaml")
+
+        self.accounts = settings.get("accounts", [])
+        self.report_interval = settings.get("report_interval", 60)
+        self.restart_delay = settings.get("restart_delay", 60)
+        self.context = multiprocessing.get_context("spawn")
+        self.reports = self.context.Queue()
+        self.workers = {}
+        self.restart_at = {}
+        # Modified time of the cookies of the accounts of which the session expired, by name
+        self.expired_cookies = {}
+        self.health = {}
+
+    def get_workspace(self, account):
+        return os.path.join(FileManager.get_project_path(), account["path"])
+
+    def get_cookies_modified_time(self, account):
+        path = os.path.join(self.get_workspace(account), "data", "cookies.json")
+        return os.path.getmtime(path) if os.path.exists(path) else None
+
+    def is_ready(self, account):
+        """Workers can't ask questions, so the workspace needs a config and cookies from a normal run beforehand."""
+        workspace = self.get_workspace(account)
+        missing = [file for file in ("config.yaml", os.path.join("data", "cookies.json"))
+                   if not os.path.exists(os.path.join(workspace, file))]
+        if missing:
+            logger.error(f"Account {account['name']} is missing {', '.join(missing)} in {workspace}, set it up first "
+                         f"with `python main.py --workspace {account['path']}`")
+            return False
+        return True
+
+    def start_worker(self, account):
+        name = account["name"]
+        process = self.context.Process(target=run_account, name=f"Account {name}", daemon=True,
+                                       args=(name, self.get_workspace(account), self.reports, self.report_interval))
+        process.start()
+        self.workers[name] = process
+        logger.info(f"Started worker for account {name} (pid {process.pid})")
+
+    def start(self):
+        logger.info(f"Supervising {len(self.accounts)} accounts")
+        accounts = [account for account in self.accounts if self.is_ready(account)]
+        for account in accounts:
+            self.start_worker(account)
+
+        next_report_at = time.time() + self.report_interval
+        while True:
+            try:
+                report = self.reports.get(timeout=1)
+                previous = self.health.get(report["account"])
+                if previous is not None:
+                    previous = {key: value for key, value in previous.items() if key != "previous"}
+                    if report["requests"] < previous["requests"]:
+                        # The worker was restarted, its counters started over
+                        previous = None
+                self.health[report["account"]] = {**report, "previous": previous}
+            except queue.Empty:
+                pass
+
+            self.check_workers(accounts)
+
+            if time.time() >= next_report_at:
+                self.log_health()
+                next_report_at = time.time() + self.report_interval
+
+    def check_workers(self, accounts):
+        """Restart the workers that stopped, after the restart delay. A worker of which the session expired is restarted
+        once the cookies of its workspace are updated."""
+        for account in accounts:
+            name = account["name"]
+            process = self.workers[name]
+            if process.is_alive():
+                continue
+
+            if process.exitcode == session_expired_exit_code:
+                if name not in self.expired_cookies:
+                    logger.error(f"Session of account {name} expired, it is restarted once its cookies are updated "
+                                 f"with `python main.py --workspace {account['path']}`")
+                    self.expired_cookies[name] = self.get_cookies_modified_time(account)
+                elif self.get_cookies_modified_time(account) != self.expired_cookies[name]:
+                    del self.expired_cookies[name]
+                    self.start_worker(account)
+            elif name not in self.restart_at:
+                logger.error(f"Worker for account {name} stopped with exit code {process.exitcode}, restarting in "
+                             f"{self.restart_delay} seconds")
+                self.restart_at[name] = time.time() + self.restart_delay
+            elif time.time() >= self.restart_at[name]:
+                del self.restart_at[name]
+                self.start_worker(account)
+
+    def log_health(self):
+        """Log the state of every worker and the combined throughput since the previous report."""
+        requests_per_minute = 0.0
+        runs_per_minute = 0.0
+        for name, process in self.workers.items():
+            health = self.health.get(name)
+            state = "running" if process.is_alive() else "stopped"
+            if name in self.expired_cookies:
+                state = "session expired"
+            if health is not None and health.get("quarantined") and process.is_alive():
+                state = "quarantined (captcha)"
+            if health is None:
+                logger.info(f"{name}: {state}, no report yet")
+                continue
+
+            previous = health["previous"]
+            if previous is not None and health["time"] > previous["time"]:
+                minutes = (health["time"] - previous["time"]) / 60
+                requests_per_minute += (health["requests"] - previous["requests"]) / minutes
+                runs_per_minute += (health["village_runs"] - previous["village_runs"]) / minutes
+
+            age = round(time.time() - health["time"])
+            logger.info(f"{name}: {state}, {health['villages']} villages, {health['village_runs']} village runs, "
+                        f"{health['requests']} requests, last report {age} seconds ago")
+
+        alive = sum(process.is_alive() for process in self.workers.values())
+        logger.info(f"{alive}/{len(self.workers)} workers running, {requests_per_minute:.1f} requests/min, "
+                    f"{runs_per_minute:.1f} village runs/min")